@@ -0,0 +1,74 @@
+"""
+Counts tensor allocations per PGD step for the out-of-place
+(:samp:`step`/:samp:`project`) and in-place (:samp:`step_`/:samp:`project_`)
+:class:`~robustness.attack_steps.AttackerStep` APIs, along with the time per
+step. On CUDA, allocations are read from the caching allocator statistics; on
+CPU, they are counted with the PyTorch profiler.
+
+Usage::
+
+    python -m benchmarks.attack_allocations --device cpu --batch-size 256
+"""
+
+from argparse import ArgumentParser
+import time
+import torch as ch
+from torch.profiler import profile, ProfilerActivity
+
+from robustness import attack_steps
+
+def count_allocations(fn, device, reps):
+    """Returns the average number of allocations made by one call of fn."""
+    if device.type == 'cuda':
+        ch.cuda.synchronize()
+        before = ch.cuda.memory_stats()['allocation.all.allocated']
+        for _ in range(reps): fn()
+        ch.cuda.synchronize()
+        return (ch.cuda.memory_stats()['allocation.all.allocated'] - before) / reps
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        for _ in range(reps): fn()
+    allocs = [e for e in prof.events() if e.name == '[memory]' and e.cpu_memory_usage > 0]
+    return len(allocs) / reps
+
+def time_per_call(fn, device, reps):
+    if device.type == 'cuda': ch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(reps): fn()
+    if device.type == 'cuda': ch.cuda.synchronize()
+    return (time.perf_counter() - start) / reps
+
+def main(args):
+    device = ch.device(args.device)
+    shape = (args.batch_size, 3, args.resolution, args.resolution)
+    orig = ch.rand(*shape, device=device)
+
+    for name, step_class in [('inf', attack_steps.LinfStep),
+                             ('2', attack_steps.L2Step)]:
+        step = step_class(orig_input=orig, eps=args.eps, step_size=args.eps / 4)
+        x = orig.clone()
+        grad = ch.randn(*shape, device=device)
+
+        def eager():
+            step.project(step.step(x, grad.clone()))
+
+        def in_place():
+            step.project_(step.step_(x, grad.clone()))
+
+        # Both variants pay for the same grad.clone(), which stands in for
+        # the gradient produced by autograd in the attack loop
+        for label, fn in [('step/project', eager), ('step_/project_', in_place)]:
+            fn() # warmup
+            allocs = count_allocations(fn, device, args.reps)
+            secs = time_per_call(fn, device, args.reps)
+            print(f'[{name}] {label:>15}: {allocs:5.1f} allocations/step, '
+                  f'{1000 * secs:8.3f} ms/step')
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--resolution', type=int, default=224)
+    parser.add_argument('--eps', type=float, default=8/255)
+    parser.add_argument('--reps', type=int, default=20)
+    main(parser.parse_args())
@@ -11,6 +11,8 @@ import or edit this module and can just think of it as internal.
 """
 
 import torch as ch
+import math
+import warnings
 
 class AttackerStep:
     '''
@@ -18,18 +20,28 @@ class AttackerStep:
     specified by an "origin input" and a perturbation magnitude.
     Must implement project, step, and random_perturb
     '''
-    def __init__(self, orig_input, eps, step_size, use_grad=True):
+    def __init__(self, orig_input, eps, step_size, use_grad=True, device=None,
+                 use_compile=False):
         '''
         Initialize the attacker step with a given perturbation magnitude.
 
         Args:
             eps (float): the perturbation magnitude
             orig_input (ch.tensor): the original input
+            device (str|ch.device|None): device to run the step on (if
+                None, use the device of orig_input)
+            use_compile (bool): if True, use a compiled kernel that fuses the
+                step and the projection (only for steps that provide one,
+                others run eagerly)
         '''
+        if device is not None:
+            orig_input = orig_input.to(device)
         self.orig_input = orig_input
+        self.device = orig_input.device
         self.eps = eps
         self.step_size = step_size
         self.use_grad = use_grad
+        self.use_compile = use_compile
 
     def project(self, x):
         '''
@@ -65,6 +77,67 @@ class AttackerStep:
         '''
         raise NotImplementedError
 
+    def step_(self, x, g):
+        '''
+        In-place version of :meth:`step`: writes the new input into
+        :samp:`x` (and may overwrite :samp:`g`, which the attack loop does
+        not reuse). The default implementation falls back to :meth:`step`;
+        subclasses should override it to avoid allocating new tensors.
+
+        Returns:
+            :samp:`x`, updated in place.
+        '''
+        return x.copy_(self.step(x, g))
+
+    def project_(self, x):
+        '''
+        In-place version of :meth:`project` (see :meth:`step_`).
+
+        Returns:
+            :samp:`x`, projected in place.
+        '''
+        return x.copy_(self.project(x))
+
+    def step_and_project_(self, x, g):
+        '''
+        Take a step and project back into the feasible set, in place. Steps
+        with a fused kernel (see :samp:`use_compile`) override this; the
+        default runs :meth:`step_` and then :meth:`project_`.
+
+        Returns:
+            :samp:`x`, updated in place.
+        '''
+        self.step_(x, g)
+        return self.project_(x)
+
+    def observe(self, x, loss, iteration, iterations):
+        '''
+        Called by the attack loop at every iteration, before taking the step,
+        with the current iterate and its per-example objective. Steps that
+        adapt to the loss history (e.g. :class:`APGDStep`) override this; by
+        default it does nothing.
+
+        Args:
+            x (ch.tensor): the current iterate
+            loss (ch.tensor): the per-example objective at :samp:`x` (higher
+                is better for the attacker, i.e. already negated for
+                targeted attacks)
+            iteration (int): index of the current iteration
+            iterations (int): total number of iterations of the attack
+        '''
+        pass
+
+    def select(self, keep):
+        '''
+        Restrict the step to a subset of the batch (used when examples drop
+        out of an attack early). Steps that keep any other per-example state
+        must override this to subset that state as well.
+
+        Args:
+            keep (ch.tensor): boolean mask (or indices) of examples to keep
+        '''
+        self.orig_input = self.orig_input[keep]
+
     def to_image(self, x):
         '''
         Given an input (which may be in an alternative parameterization),
@@ -75,6 +148,50 @@ class AttackerStep:
         '''
         return x
 
+### Fused step + projection kernels for the built-in steps. Eagerly, the
+### step and the projection each read and write the whole batch several
+### times; compiled, each becomes (close to) a single pass.
+
+def _linf_step_project(x, g, orig_input, eps: float, step_size: float):
+    x = x + step_size * ch.sign(g)
+    diff = ch.clamp(x - orig_input, -eps, eps)
+    return ch.clamp(diff + orig_input, 0, 1)
+
+def _l2_step_project(x, g, orig_input, eps: float, step_size: float):
+    shape = [-1] + [1] * (x.dim() - 1)
+    g_norm = g.flatten(1).norm(dim=1).view(shape)
+    diff = x + step_size * g / (g_norm + 1e-10) - orig_input
+    # Same scaling as Tensor.renorm
+    d_norm = diff.flatten(1).norm(dim=1).view(shape)
+    diff = diff * ch.where(d_norm > eps, eps / (d_norm + 1e-7), ch.ones_like(d_norm))
+    return ch.clamp(orig_input + diff, 0, 1)
+
+_COMPILED_KERNELS = {}
+
+def _run_compiled(fn, *args):
+    '''
+    Run fn compiled (with torch.compile, or TorchScript on older versions of
+    PyTorch), compiling it on first use. Falls back to eager mode (with a
+    warning) if compilation fails.
+    '''
+    if fn not in _COMPILED_KERNELS:
+        try:
+            if hasattr(ch, 'compile'):
+                _COMPILED_KERNELS[fn] = ch.compile(fn, dynamic=True)
+            else:
+                _COMPILED_KERNELS[fn] = ch.jit.script(fn)
+        except Exception as e:
+            warnings.warn(f'Could not compile {fn.__name__}, running eagerly: {e}')
+            _COMPILED_KERNELS[fn] = fn
+    try:
+        return _COMPILED_KERNELS[fn](*args)
+    except Exception as e:
+        # torch.compile only compiles (and so only fails) on the first call
+        if _COMPILED_KERNELS[fn] is fn: raise
+        warnings.warn(f'Could not compile {fn.__name__}, running eagerly: {e}')
+        _COMPILED_KERNELS[fn] = fn
+        return fn(*args)
+
 ### Instantiations of the AttackerStep class
 
 # L-infinity threat model
@@ -98,6 +215,25 @@ class LinfStep(AttackerStep):
         step = ch.sign(g) * self.step_size
         return x + step
 
+    def project_(self, x):
+        """
+        """
+        x.sub_(self.orig_input).clamp_(-self.eps, self.eps)
+        return x.add_(self.orig_input).clamp_(0, 1)
+
+    def step_(self, x, g):
+        """
+        """
+        return x.add_(g.sign_(), alpha=self.step_size)
+
+    def step_and_project_(self, x, g):
+        """
+        """
+        if not self.use_compile:
+            return super().step_and_project_(x, g)
+        return x.copy_(_run_compiled(_linf_step_project, x, g, self.orig_input,
+                                     float(self.eps), float(self.step_size)))
+
     def random_perturb(self, x):
         """
         """
@@ -127,6 +263,28 @@ class L2Step(AttackerStep):
         scaled_g = g / (g_norm + 1e-10)
         return x + scaled_g * self.step_size
 
+    def project_(self, x):
+        """
+        """
+        x.sub_(self.orig_input).renorm_(p=2, dim=0, maxnorm=self.eps)
+        return x.add_(self.orig_input).clamp_(0, 1)
+
+    def step_(self, x, g):
+        """
+        """
+        l = len(x.shape) - 1
+        g_norm = ch.norm(g.view(g.shape[0], -1), dim=1).view(-1, *([1]*l))
+        g.div_(g_norm.add_(1e-10))
+        return x.add_(g, alpha=self.step_size)
+
+    def step_and_project_(self, x, g):
+        """
+        """
+        if not self.use_compile:
+            return super().step_and_project_(x, g)
+        return x.copy_(_run_compiled(_l2_step_project, x, g, self.orig_input,
+                                     float(self.eps), float(self.step_size)))
+
     def random_perturb(self, x):
         """
         """
@@ -156,12 +314,47 @@ class UnconstrainedStep(AttackerStep):
         new_x = x + (ch.rand_like(x) - 0.5).renorm(p=2, dim=0, maxnorm=step_size)
         return ch.clamp(new_x, 0, 1)
 
+# Frequency scaling buffers for FourierStep, keyed by (height, width,
+# decay_power, device, dtype)
+_SPECTRUM_SCALES = {}
+
+def _spectrum_scale(h, w, decay_power, device, dtype):
+    key = (h, w, decay_power, str(device), dtype)
+    if key not in _SPECTRUM_SCALES:
+        fy = ch.fft.fftfreq(h, device=device, dtype=dtype)[:, None]
+        fx = ch.fft.rfftfreq(w, device=device, dtype=dtype)[None, :]
+        freqs = (fy ** 2 + fx ** 2).sqrt()
+        _SPECTRUM_SCALES[key] = freqs.clamp(min=1. / max(h, w)) ** -decay_power
+    return _SPECTRUM_SCALES[key]
+
 class FourierStep(AttackerStep):
     """
     Step under the Fourier (decorrelated) parameterization of an image.
 
+    The parameterization is the real half-spectrum of the (pre-sigmoid)
+    image, i.e. a real tensor of shape ``(N, C, H, W // 2 + 1, 2)`` holding
+    the real and imaginary parts of its :samp:`torch.fft.rfft2` (see
+    :meth:`random_coefficients`); the image width ``W`` must be even.
+    Coefficients are scaled by :math:`1/f^d` for spatial frequency :math:`f`
+    and :samp:`d = decay_power` before the inverse transform, which decorrelates
+    them so that gradient steps are not dominated by high frequencies. The
+    scaling buffers are computed once per image shape and shared by all
+    steps.
+
     See https://distill.pub/2017/feature-visualization/#preconditioning for more information.
     """
+    decay_power = 1.
+
+    @staticmethod
+    def random_coefficients(shape, std=0.01, device=None):
+        """
+        Random Fourier coefficients for images of shape
+        :samp:`shape = (N, C, H, W)`, to use as the starting point
+        :samp:`x` of an attack.
+        """
+        N, C, H, W = shape
+        return std * ch.randn(N, C, H, W // 2 + 1, 2, device=device)
+
     def project(self, x):
         """
         """
@@ -172,6 +365,16 @@ class FourierStep(AttackerStep):
         """
         return x + g * self.step_size
 
+    def step_(self, x, g):
+        """
+        """
+        return x.add_(g, alpha=self.step_size)
+
+    def project_(self, x):
+        """
+        """
+        return x
+
     def random_perturb(self, x):
         """
         """
@@ -180,7 +383,127 @@ class FourierStep(AttackerStep):
     def to_image(self, x):
         """
         """
-        return ch.sigmoid(ch.irfft(x, 2, normalized=True, onesided=False))
+        h, w = x.shape[-3], 2 * (x.shape[-2] - 1)
+        scale = _spectrum_scale(h, w, self.decay_power, x.device, x.dtype)
+        spectrum = ch.view_as_complex(x.contiguous()) * scale
+        return ch.sigmoid(ch.fft.irfft2(spectrum, s=(h, w), norm='ortho'))
+
+class APGDStep(AttackerStep):
+    """
+    Auto-PGD step [CH20]_ for the :math:`\ell_\infty` threat model. PGD with
+    momentum and a per-example step size, which starts at ``step_size`` (the
+    paper uses :math:`2\epsilon`) and is halved at fixed checkpoints whenever
+    the attack has stalled since the previous checkpoint, in which case the
+    attack also restarts from the best point found so far.
+
+    Requires the attack loop to call :meth:`observe` with the loss at every
+    iteration (which :class:`robustness.attacker.Attacker` does).
+
+    .. [CH20] Croce and Hein, "Reliable evaluation of adversarial robustness
+        with an ensemble of diverse parameter-free attacks", 2020.
+    """
+    momentum = 0.75
+    rho = 0.75
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.eta = None
+        self.x_prev = None
+
+    project = LinfStep.project
+    project_ = LinfStep.project_
+    random_perturb = LinfStep.random_perturb
+
+    @staticmethod
+    def checkpoints(iterations):
+        """
+        Iterations at which the step size may be halved
+        (:math:`\lceil p_j N \rceil` in the paper).
+        """
+        p = [0, 0.22]
+        while p[-1] + max(p[-1] - p[-2] - 0.03, 0.06) <= 1:
+            p.append(p[-1] + max(p[-1] - p[-2] - 0.03, 0.06))
+        return sorted(set(int(math.ceil(q * iterations)) for q in p[1:]))
+
+    def observe(self, x, loss, iteration, iterations):
+        """
+        """
+        if self.eta is None:
+            n = loss.shape[0]
+            self.eta = ch.full((n,), float(self.step_size), device=loss.device)
+            self.best_loss = loss.clone()
+            self.best_x = x.detach().clone()
+            self.prev_loss = loss.clone()
+            self.num_increases = ch.zeros(n, device=loss.device)
+            self.ckpt_best_loss = loss.clone()
+            self.ckpt_reduced = ch.zeros(n, dtype=ch.bool, device=loss.device)
+            self.restart = ch.zeros(n, dtype=ch.bool, device=loss.device)
+            self.last_ckpt = 0
+            self.ckpts = self.checkpoints(iterations)
+            return
+
+        self.num_increases += (loss > self.prev_loss).float()
+        self.prev_loss.copy_(loss)
+        improved = loss > self.best_loss
+        ch.where(improved, loss, self.best_loss, out=self.best_loss)
+        improved = improved.view(-1, *([1] * (len(x.shape) - 1)))
+        ch.where(improved, x.detach(), self.best_x, out=self.best_x)
+
+        self.restart.zero_()
+        if iteration in self.ckpts:
+            # Halve the step size (and restart from the best point) where
+            # too few steps increased the loss, or where neither the step
+            # size nor the best loss changed since the last checkpoint
+            window = iteration - self.last_ckpt
+            stalled = self.num_increases < self.rho * window
+            stuck = ~self.ckpt_reduced & (self.ckpt_best_loss >= self.best_loss)
+            reduce = stalled | stuck
+            self.eta = ch.where(reduce, self.eta / 2, self.eta)
+            self.restart = reduce
+            self.ckpt_reduced = reduce
+            self.ckpt_best_loss = self.best_loss.clone()
+            self.num_increases.zero_()
+            self.last_ckpt = iteration
+
+    def step(self, x, g):
+        """
+        """
+        shape = [-1] + [1] * (len(x.shape) - 1)
+        eta = self.eta.view(shape) if self.eta is not None else self.step_size
+        z = self.project(x + eta * ch.sign(g))
+        if self.x_prev is None:
+            new_x = z
+        else:
+            a = self.momentum
+            new_x = self.project(x + a * (z - x) + (1 - a) * (x - self.x_prev))
+        self.x_prev = x.detach().clone()
+
+        if self.eta is not None and self.restart.any():
+            restart = self.restart.view(shape)
+            new_x = ch.where(restart, self.best_x, new_x)
+            self.x_prev = ch.where(restart, self.best_x, self.x_prev)
+        return new_x
+
+    def step_(self, x, g):
+        """
+        """
+        return x.copy_(self.step(x, g))
+
+    def step_and_project_(self, x, g):
+        """
+        """
+        return self.project_(self.step_(x, g))
+
+    def select(self, keep):
+        """
+        """
+        super().select(keep)
+        if self.x_prev is not None:
+            self.x_prev = self.x_prev[keep]
+        if self.eta is not None:
+            for k in ['eta', 'best_loss', 'best_x', 'prev_loss', 'num_increases',
+                      'ckpt_best_loss', 'ckpt_reduced', 'restart']:
+                setattr(self, k, getattr(self, k)[keep])
 
 class RandomStep(AttackerStep):
     """
@@ -204,3 +527,229 @@ class RandomStep(AttackerStep):
         """
         """
         return x
+
+class HopSkipJumpStep(AttackerStep):
+    """
+    Decision-based (label-only) attack step in the style of HopSkipJumpAttack
+    [CJW20]_ for the :math:`\ell_2` threat model (see
+    :class:`HopSkipJumpLinfStep` for :math:`\ell_\infty`).
+
+    Starting from an adversarial point, each iteration estimates the
+    gradient direction of the decision boundary from the labels of random
+    queries around the current boundary point, steps along it with a
+    geometric step size search, and binary-searches back to the boundary
+    towards :samp:`orig_input`; the distance to :samp:`orig_input` shrinks
+    over the iterations. The step only holds the geometry of the threat
+    model: the queries are made (batched over all examples) by the attack
+    loop, :meth:`robustness.attacker.Attacker.forward`, which uses
+    :samp:`iterations` as the number of HopSkipJump iterations and ignores
+    :samp:`step_size`. The result is projected onto the :samp:`eps` ball.
+
+    .. [CJW20] Chen, Jordan and Wainwright, "HopSkipJumpAttack: A
+        Query-Efficient Decision-Based Attack", 2020.
+    """
+    decision_based = True
+    # Number of random starting points to try to find an adversarial one
+    init_attempts = 10
+    # Number of gradient estimation queries at the first iteration (growing
+    # as sqrt(t + 1)) and at most
+    init_evals = 100
+    max_evals = 10000
+    # Maximum number of halvings in the geometric step size search
+    max_halvings = 25
+    # Maximum number of binary search steps
+    max_bs_steps = 25
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.use_grad = False
+
+    project = L2Step.project
+
+    def step(self, x, g):
+        """
+        """
+        return x
+
+    def random_perturb(self, x):
+        """
+        """
+        return x
+
+    def _view(self, v, x):
+        return v.view(-1, *([1] * (len(x.shape) - 1)))
+
+    def distance(self, orig, x):
+        """Per-example distance between :samp:`x` and :samp:`orig`."""
+        return (x - orig).view(x.shape[0], -1).norm(dim=1)
+
+    def theta(self, x):
+        """Binary search tolerance (on the blending coefficient)."""
+        d = x[0].numel()
+        return 1. / d ** 1.5
+
+    def delta(self, x, dist, it):
+        """Radius of the gradient estimation queries at iteration :samp:`it`."""
+        if it == 0:
+            return ch.full_like(dist, 0.1)
+        return x[0].numel() ** 0.5 * self.theta(x) * dist
+
+    def blend(self, orig, x_adv, t):
+        """
+        Points between :samp:`orig` (:samp:`t = 0`) and :samp:`x_adv`
+        (:samp:`t = 1`), used for the binary search.
+        """
+        return orig + self._view(t, orig) * (x_adv - orig)
+
+    def random_directions(self, x, num):
+        """:samp:`num` random unit directions for each example (num x N x ...)."""
+        u = ch.randn(num, *x.shape, device=x.device, dtype=x.dtype)
+        norm = u.view(num, x.shape[0], -1).norm(dim=2)
+        return u / norm.view(num, x.shape[0], *([1] * (len(x.shape) - 1)))
+
+    def update_direction(self, grad):
+        """Direction to step along, from the estimated gradient."""
+        norm = grad.view(grad.shape[0], -1).norm(dim=1)
+        return grad / (self._view(norm, grad) + 1e-12)
+
+    def initial_step_size(self, dist, it):
+        """Initial size of the geometric step size search."""
+        return dist / (it + 1) ** 0.5
+
+class HopSkipJumpLinfStep(HopSkipJumpStep):
+    """
+    :class:`HopSkipJumpStep` for the :math:`\ell_\infty` threat model.
+    """
+    project = LinfStep.project
+
+    def distance(self, orig, x):
+        """Per-example distance between :samp:`x` and :samp:`orig`."""
+        return (x - orig).view(x.shape[0], -1).abs().max(dim=1)[0]
+
+    def theta(self, x):
+        """Binary search tolerance (on the blending coefficient)."""
+        return 1. / x[0].numel() ** 2
+
+    def delta(self, x, dist, it):
+        """Radius of the gradient estimation queries at iteration :samp:`it`."""
+        if it == 0:
+            return ch.full_like(dist, 0.1)
+        return x[0].numel() * self.theta(x) * dist
+
+    def blend(self, orig, x_adv, t):
+        """
+        Points between :samp:`orig` (:samp:`t = 0`) and :samp:`x_adv`
+        (:samp:`t = 1`): :samp:`x_adv` clipped to the :math:`\ell_\infty`
+        ball around :samp:`orig` of radius :samp:`t` times their distance.
+        """
+        r = self._view(t * self.distance(orig, x_adv), orig)
+        return orig + ch.max(ch.min(x_adv - orig, r), -r)
+
+    def random_directions(self, x, num):
+        """:samp:`num` random directions for each example (num x N x ...)."""
+        return 2 * ch.rand(num, *x.shape, device=x.device, dtype=x.dtype) - 1
+
+    def update_direction(self, grad):
+        """Direction to step along, from the estimated gradient."""
+        return ch.sign(grad)
+
+class SquareStep(AttackerStep):
+    """
+    Score-based (gradient-free) random search step in the style of Square
+    Attack [ACFH20]_ for the :math:`\ell_\infty` threat model (see
+    :class:`SquareL2Step` for :math:`\ell_2`).
+
+    Starting from vertical stripes of :math:`\pm\epsilon`, each iteration
+    proposes to change the perturbation on one random square window per
+    example (to a random vertex of the :math:`\ell_\infty` ball, per
+    channel), and keeps the proposal for the examples whose loss improves.
+    The size of the windows shrinks over the iterations. The step only
+    proposes the candidates: the attack loop,
+    :meth:`robustness.attacker.Attacker.forward`, evaluates the proposals for
+    the whole batch in one forward pass (and no backward pass), and uses
+    :samp:`iterations` as the number of proposals; :samp:`step_size` is
+    ignored. Only image-shaped (N x C x H x W) inputs are supported.
+
+    .. [ACFH20] Andriushchenko, Croce, Flammarion and Hein, "Square Attack: a
+        query-efficient black-box adversarial attack via random search", 2020.
+    """
+    random_search = True
+    # Initial fraction of the pixels changed by a proposal
+    p_init = 0.05
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.use_grad = False
+
+    project = LinfStep.project
+
+    def step(self, x, g):
+        """
+        """
+        return x
+
+    def random_perturb(self, x):
+        """
+        Vertical stripes of :math:`\pm\epsilon` (per channel and column).
+        """
+        n, c, _, w = x.shape
+        signs = 2 * ch.randint(0, 2, (n, c, 1, w), device=x.device).to(x.dtype) - 1
+        return ch.clamp(x + self.eps * signs, 0, 1)
+
+    def square_size(self, it, iterations, h, w):
+        """
+        Side of the square windows at iteration :samp:`it`, following the
+        piecewise constant schedule of [ACFH20]_ (for 10000 iterations,
+        rescaled to :samp:`iterations`).
+        """
+        it = int(it / iterations * 10000)
+        halvings = sum(it > t for t in [10, 50, 200, 500, 1000, 2000, 4000,
+                                        6000, 8000])
+        p = self.p_init / 2 ** halvings
+        return int(min(max(round(math.sqrt(p * h * w)), 1), h - 1, w - 1))
+
+    def _window(self, x, s):
+        # Mask (N x 1 x H x W) of a random s x s window for each example
+        n, _, h, w = x.shape
+        r = ch.randint(0, h - s + 1, (n, 1, 1, 1), device=x.device)
+        c = ch.randint(0, w - s + 1, (n, 1, 1, 1), device=x.device)
+        rows = ch.arange(h, device=x.device).view(1, 1, h, 1)
+        cols = ch.arange(w, device=x.device).view(1, 1, 1, w)
+        return (rows >= r) & (rows < r + s) & (cols >= c) & (cols < c + s)
+
+    def propose(self, x, orig, s):
+        """
+        One proposal for each example of :samp:`x` (with original inputs
+        :samp:`orig`), changing the perturbation on a random :samp:`s` x
+        :samp:`s` window.
+        """
+        n, c = x.shape[:2]
+        signs = 2 * ch.randint(0, 2, (n, c, 1, 1), device=x.device).to(x.dtype) - 1
+        cand = ch.clamp(orig + self.eps * signs, 0, 1)
+        return ch.where(self._window(x, s), cand, x)
+
+class SquareL2Step(SquareStep):
+    """
+    :class:`SquareStep` for the :math:`\ell_2` threat model. This is a
+    simplified version of the :math:`\ell_2` Square Attack: it starts from a
+    random point of the :math:`\epsilon` sphere, and each proposal adds a
+    square of constant per-channel sign and norm :math:`\epsilon` to the
+    perturbation before projecting back onto the ball (instead of moving
+    perturbation mass between windows with the paper's centered profiles).
+    """
+    p_init = 0.1
+
+    project = L2Step.project
+    random_perturb = L2Step.random_perturb
+
+    def propose(self, x, orig, s):
+        """
+        One proposal for each example of :samp:`x` (with original inputs
+        :samp:`orig`), adding a square of norm :samp:`eps` on a random
+        :samp:`s` x :samp:`s` window.
+        """
+        n, c = x.shape[:2]
+        signs = 2 * ch.randint(0, 2, (n, c, 1, 1), device=x.device).to(x.dtype) - 1
+        square = self._window(x, s).to(x.dtype) * signs * self.eps / (s * math.sqrt(c))
+        diff = (x + square - orig).renorm(p=2, dim=0, maxnorm=self.eps)
+        return ch.clamp(orig + diff, 0, 1)
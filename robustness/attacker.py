@@ -12,7 +12,8 @@ model and adds to it adversarial attack functionalities as well as other useful
 options. See :meth:`robustness.attacker.AttackerModel.forward` for documentation
 on which arguments AttackerModel supports, and see
 :meth:`robustness.attacker.Attacker.forward` for the arguments pertaining to
-adversarial examples specifically.
+adversarial examples specifically. :meth:`robustness.attacker.certify`
+computes randomized-smoothing certificates for an AttackerModel.
 
 For a demonstration of this module in action, see the walkthrough
 ":doc:`../example_usage/input_space_manipulation`"
@@ -29,13 +30,15 @@ called directly---instead, these arguments are passed along from
 
 import torch as ch
 import dill
+import inspect
 import os
+from contextlib import nullcontext
 if int(os.environ.get("NOTEBOOK_MODE", 0)) == 1:
     from tqdm import tqdm_notebook as tqdm
 else:
     from tqdm import tqdm
 
-from .tools import helpers
+from .tools import helpers, adv_cache
 from . import attack_steps
 
 STEPS = {
@@ -43,9 +46,80 @@ STEPS = {
     '2': attack_steps.L2Step,
     'unconstrained': attack_steps.UnconstrainedStep,
     'fourier': attack_steps.FourierStep,
-    'random_smooth': attack_steps.RandomStep
+    'random_smooth': attack_steps.RandomStep,
+    'apgd': attack_steps.APGDStep,
+    'hsj_2': attack_steps.HopSkipJumpStep,
+    'hsj_inf': attack_steps.HopSkipJumpLinfStep,
+    'square_inf': attack_steps.SquareStep,
+    'square_2': attack_steps.SquareL2Step
 }
 
+# Loss scale for float16 mixed-precision attacks
+ATTACK_LOSS_SCALE = 2. ** 10
+
+def output_loss(loss_fn):
+    """
+    Decorator marking a custom attack loss (see :samp:`custom_loss` in
+    :meth:`Attacker.forward`) as taking the output of the model instead of
+    the model itself::
+
+        @output_loss
+        def feature_loss(logits, latent, target):
+            return ch.norm(latent - target, dim=1)
+
+    The attack then runs a single forward pass (with :samp:`with_latent=True`)
+    per iteration and hands its logits and latent representation to the
+    loss, which returns a tensor of size N (per-element loss). Undecorated
+    losses keep the :samp:`model, x, target` signature, and run the model
+    themselves.
+    """
+    loss_fn.output_loss = True
+    return loss_fn
+
+def is_output_loss(loss_fn):
+    """Whether ``loss_fn`` is decorated with :meth:`output_loss`."""
+    return getattr(loss_fn, 'output_loss', False)
+
+def _cat_results(rets):
+    """
+    Concatenates the results of attacks on consecutive parts of a batch
+    (tensors, or tuples/dictionaries of tensors) along the batch dimension.
+    """
+    first = rets[0]
+    if isinstance(first, tuple):
+        return tuple(_cat_results(parts) for parts in zip(*rets))
+    if isinstance(first, dict):
+        return {k: _cat_results([r[k] for r in rets]) for k in first}
+    return ch.cat(rets)
+
+def _tile(t, reps):
+    """Repeat a batch ``reps`` times along the batch dimension."""
+    return t.repeat(reps, *([1] * (len(t.shape) - 1)))
+
+def _accepted_kwargs(cls, kwargs):
+    """
+    The keyword arguments in ``kwargs`` that the constructor of ``cls``
+    accepts (custom AttackerStep subclasses may override ``__init__`` without
+    the ``device`` and ``use_compile`` arguments).
+    """
+    params = inspect.signature(cls.__init__).parameters.values()
+    if any(p.kind == p.VAR_KEYWORD for p in params):
+        return kwargs
+    names = {p.name for p in params}
+    return {k: v for k, v in kwargs.items() if k in names}
+
+def _attack_success(output, target, targeted):
+    """
+    Per-example attack success (misclassified, or classified as the target if
+    ``targeted``), or ``None`` if it cannot be determined from ``output``
+    (e.g. custom losses that do not return logits).
+    """
+    if not isinstance(output, ch.Tensor) or len(target.shape) != 1 \
+            or len(output.shape) != 2:
+        return None
+    pred = output.argmax(dim=1)
+    return (pred == target) if targeted else (pred != target)
+
 class Attacker(ch.nn.Module):
     """
     Attacker class, used to make adversarial examples.
@@ -57,23 +131,30 @@ class Attacker(ch.nn.Module):
     However, the :meth:`robustness.Attacker.forward` function below
     documents the arguments supported for adversarial attacks specifically.
     """
-    def __init__(self, model, dataset):
+    def __init__(self, model, dataset, device=None):
         """
         Initialize the Attacker
 
         Args:
             nn.Module model : the PyTorch model to attack
             Dataset dataset : dataset the model is trained on, only used to get mean and std for normalization
+            str|ch.device device : device to run attacks on (if None, use the
+                device of the input being attacked)
         """
         super(Attacker, self).__init__()
         self.normalize = helpers.InputNormalize(dataset.mean, dataset.std)
         self.model = model
+        self.device = device
 
     def forward(self, x, target, *_, constraint, eps, step_size, iterations,
                 random_start=False, random_restarts=False, do_tqdm=False,
                 targeted=False, custom_loss=None, should_normalize=True,
                 orig_input=None, use_best=True, return_image=True,
-                est_grad=None, mixed_precision=False):
+                est_grad=None, mixed_precision=False, batched_restarts=False,
+                early_stop=False, return_info=False, compile_step=False,
+                query_pool=None, query_budget=None, profiler=None, trace=False,
+                multi_target=False, target_chunk_size=None,
+                loss_batch_size=None):
         """
         Implementation of forward (finds adversarial examples). Note that
         this does **not** perform inference and should not be called
@@ -83,10 +164,17 @@ class Attacker(ch.nn.Module):
         Args:
             x, target (ch.tensor) : see :meth:`robustness.attacker.AttackerModel.forward`
             constraint
-                ("2"|"inf"|"unconstrained"|"fourier"|:class:`~robustness.attack_steps.AttackerStep`)
+                ("2"|"inf"|"unconstrained"|"fourier"|"apgd"|"hsj_2"|"hsj_inf"|"square_inf"|"square_2"|:class:`~robustness.attack_steps.AttackerStep`)
                 : threat model for adversarial attacks (:math:`\ell_2` ball,
-                :math:`\ell_\infty` ball, :math:`[0, 1]^n`, Fourier basis, or
-                custom AttackerStep subclass).
+                :math:`\ell_\infty` ball, :math:`[0, 1]^n`, Fourier basis,
+                :math:`\ell_\infty` ball with Auto-PGD steps (see
+                :class:`~robustness.attack_steps.APGDStep`), decision-based
+                :math:`\ell_2` / :math:`\ell_\infty` HopSkipJump attacks (see
+                :class:`~robustness.attack_steps.HopSkipJumpStep`; these
+                ignore random restarts), gradient-free :math:`\ell_\infty` /
+                :math:`\ell_2` Square Attacks (see
+                :class:`~robustness.attack_steps.SquareStep`; these also
+                ignore random restarts), or custom AttackerStep subclass).
             eps (float) : radius for threat model.
             step_size (float) : step size for adversarial attacks.
             iterations (int): number of steps for adversarial attacks.
@@ -100,7 +188,10 @@ class Attacker(ch.nn.Module):
                 adversarial attack. The function should take in
                 :samp:`model, x, target` and return a tuple of the form
                 :samp:`loss, None`, where loss is a tensor of size N
-                (per-element loss).
+                (per-element loss). Functions decorated with
+                :meth:`output_loss` instead take in the output of the
+                forward pass the attack has already made,
+                :samp:`logits, latent, target`, and return the loss only.
             should_normalize (bool) : If False, don't normalize the input
                 (not recommended unless normalization is done in the
                 custom_loss instead).
@@ -120,8 +211,83 @@ class Attacker(ch.nn.Module):
                 :math:`\\nabla_x f(x) \\approx \\sum_{i=0}^N f(x + R\\cdot
                 \\vec{\\delta_i})\\cdot \\vec{\\delta_i}`, where
                 :math:`\delta_i` are randomly sampled from the unit ball.
+                A third element :samp:`chunk_size` can be given to evaluate
+                the queries :samp:`chunk_size` pairs at a time, bounding
+                peak memory (see :meth:`robustness.tools.helpers.calc_est_grad`).
             mixed_precision (bool) : if True, use mixed-precision calculations
-                to compute the adversarial examples / do the inference.
+                to compute the adversarial examples / do the inference
+                (``torch.autocast`` with float16 on CUDA and bfloat16 on the
+                CPU; see :meth:`robustness.tools.helpers.autocast`).
+            batched_restarts (bool) : if True (and :samp:`random_restarts`
+                is set), run all restarts at once as a single batch that is
+                :samp:`random_restarts` times larger, and keep, for each
+                input, the restart that is successful (or, if none are, the
+                one with the worst-case loss). Faster than running restarts
+                one after another whenever the batch fits in memory.
+            early_stop (bool|function) : if True, stop attacking an example
+                (and stop spending forward/backward passes on it) as soon as
+                it is misclassified (or classified as :samp:`target` if
+                :samp:`targeted`). Can also be a function taking in
+                :samp:`output, target` (logits and labels of the examples
+                still being attacked) and returning a boolean tensor of size
+                N which is True for examples that are done.
+            return_info (bool) : if True, return a tuple
+                :samp:`(adv, info)` where :samp:`info` is a dictionary of
+                per-example tensors: :samp:`info['iterations']` is the number
+                of steps spent on each example and :samp:`info['queries']`
+                the number of model queries (forward passes, including the
+                finite-difference queries of :samp:`est_grad`), both summed
+                over restarts.
+            compile_step (bool) : if True, use compiled kernels that fuse the
+                step and projection into one pass over the batch (for the
+                built-in :samp:`"inf"` and :samp:`"2"` constraints; other
+                steps run eagerly). The first call pays the compilation cost.
+            query_pool (:class:`~robustness.tools.query_pool.QueryPool`|None) :
+                if given (along with :samp:`est_grad`), evaluate the
+                gradient estimation queries in this pool of worker
+                processes instead of in the current process.
+            query_budget (int|None) : if given, a hard limit on the number of
+                model queries (as counted in :samp:`info['queries']`) per
+                example, split evenly between random restarts. An example is
+                dropped from the attack (keeping its best iterate so far)
+                as soon as its next iteration would exceed the budget.
+            profiler (AttackProfiler|None) : if given, a
+                :class:`~robustness.tools.attack_profiler.AttackProfiler`
+                recording the time and memory use of each phase of each
+                iteration of the attack.
+            trace (bool) : if True (with :samp:`return_info`), also record
+                the convergence of the attack: :samp:`info['loss_trace']` is
+                an (N x R x (iterations + 1)) float16 tensor with the loss of
+                each example at each iteration of each of the R restarts (R
+                = 1 without restarts; the last column is the final iterate,
+                evaluated after the last step; NaN once an example has been
+                dropped from the attack), and :samp:`info['first_success']`
+                an (N x R) tensor with the first iteration (or
+                :samp:`iterations` for the final iterate) at which each
+                example was misclassified (or classified as the target if
+                :samp:`targeted`) in each restart, or -1 if it never was.
+                Both stay on the device of the attack.
+            multi_target (bool) : if True (requires :samp:`targeted`),
+                :samp:`target` is an (N x K) tensor of K target classes for
+                each input (e.g. every class, with
+                :samp:`ch.arange(num_classes).repeat(N, 1)`), and the
+                inputs are attacked towards all their targets as one
+                expanded batch of N * K examples. Returns a tuple
+                :samp:`(adv, success)` (followed by :samp:`info` if
+                :samp:`return_info`, with entries of shape (N x K x ...)):
+                the (N x K x ...) adversarial examples and the (N x K)
+                boolean matrix of which of them are classified as their
+                target.
+            target_chunk_size (int|None) : with :samp:`multi_target`, attack
+                at most this many (input, target) pairs at a time to bound
+                memory (default: all N * K at once).
+            loss_batch_size (int|None) : number of inputs of the full batch
+                when :samp:`x` is only part of it (e.g. a micro-batch, see
+                :samp:`max_attack_batch` in
+                :meth:`AttackerModel.forward`). The attack loss is summed
+                over the examples and divided by the size of the full batch,
+                so that the step of each example does not depend on how the
+                batch is split (default: the size of :samp:`x`).
         Returns:
             An adversarial example for x (i.e. within a feasible set
             determined by `eps` and `constraint`, but classified as:
@@ -133,37 +299,102 @@ class Attacker(ch.nn.Module):
             from the unit ball, and then use :math:`\delta_{N/2+i} =
             -\delta_{i}`.
         """
+        if multi_target:
+            kwargs = dict(constraint=constraint, eps=eps, step_size=step_size,
+                          iterations=iterations, random_start=random_start,
+                          random_restarts=random_restarts, do_tqdm=do_tqdm,
+                          targeted=targeted, custom_loss=custom_loss,
+                          should_normalize=should_normalize,
+                          orig_input=orig_input, use_best=use_best,
+                          return_image=return_image, est_grad=est_grad,
+                          mixed_precision=mixed_precision,
+                          batched_restarts=batched_restarts,
+                          early_stop=early_stop, return_info=return_info,
+                          compile_step=compile_step, query_pool=query_pool,
+                          query_budget=query_budget, profiler=profiler,
+                          trace=trace, loss_batch_size=loss_batch_size)
+            return self._multi_target_attack(x, target, target_chunk_size,
+                                             **kwargs)
+
         # Can provide a different input to make the feasible set around
         # instead of the initial point
+        device = self.device if self.device is not None else x.device
+        x, target = x.to(device), target.to(device)
         if orig_input is None: orig_input = x.detach()
-        orig_input = orig_input.cuda()
+        orig_input = orig_input.to(device)
 
         # Multiplier for gradient ascent [untargeted] or descent [targeted]
         m = -1 if targeted else 1
 
+        # The attack loss is normalized by the size of the full (untiled)
+        # batch (see loss_batch_size), so that batched restarts take the
+        # same steps as sequential ones
+        loss_divisor = loss_batch_size or x.shape[0]
+
         # Initialize step class and attacker criterion
         criterion = ch.nn.CrossEntropyLoss(reduction='none')
         step_class = STEPS[constraint] if isinstance(constraint, str) else constraint
-        step = step_class(eps=eps, orig_input=orig_input, step_size=step_size) 
+        step_kwargs = {'device': device}
+        if compile_step: step_kwargs['use_compile'] = True
+        step_kwargs = _accepted_kwargs(step_class, step_kwargs)
+        def make_step(orig_input):
+            return step_class(eps=eps, orig_input=orig_input,
+                              step_size=step_size, **step_kwargs)
+        step = make_step(orig_input)
+
+        # Profiling phases of the attack (no-op without a profiler)
+        if profiler is not None:
+            profiler.start_attack()
+            phase = profiler.phase
+        else:
+            phase = lambda name: nullcontext()
+
+        if query_pool is not None and query_pool.custom_loss is not custom_loss:
+            raise ValueError("query_pool must be created with the same "
+                             "custom_loss as the attack")
+
+        # Constant loss scale for float16 backward passes (bfloat16 has the
+        # range of float32 and needs none)
+        use_fp16 = mixed_precision and ch.device(device).type == 'cuda'
+        loss_scale = ATTACK_LOSS_SCALE if use_fp16 else 1
+
+        # Early stopping criterion (when to drop an example from the attack)
+        if early_stop and not callable(early_stop):
+            def is_done(output, target):
+                success = _attack_success(output, target, targeted)
+                if success is None:
+                    raise ValueError("early_stop=True requires the loss to "
+                                     "return logits; pass a callable instead.")
+                return success
+        else:
+            is_done = early_stop
 
         def calc_loss(inp, target):
             '''
             Calculates the loss of an input with respect to target labels
             Uses custom loss (if provided) otherwise the criterion
             '''
-            if should_normalize:
-                inp = self.normalize(inp)
-            output = self.model(inp)
-            if custom_loss:
-                return custom_loss(self.model, inp, target)
+            with helpers.autocast(device, mixed_precision):
+                if should_normalize:
+                    inp = self.normalize(inp)
+                if is_output_loss(custom_loss):
+                    output, latent = self.model(inp, with_latent=True)
+                    loss = custom_loss(output, latent, target)
+                elif custom_loss:
+                    loss, output = custom_loss(self.model, inp, target)
+                else:
+                    output = self.model(inp)
+                    loss = criterion(output, target)
 
-            return criterion(output, target), output
+            return loss.float(), output
 
         # Main function for making adversarial examples
-        def get_adv_examples(x):
-            # Random start (to escape certain types of gradient masking)
+        def get_adv_examples(x, step, target, track_best=False):
+            # Random start (to escape certain types of gradient masking),
+            # projected so that warm starts (x != orig_input) stay in the
+            # threat model
             if random_start:
-                x = step.random_perturb(x)
+                x = step.project(step.random_perturb(x))
 
             iterator = range(iterations)
             if do_tqdm: iterator = tqdm(iterator)
@@ -173,83 +404,557 @@ class Attacker(ch.nn.Module):
             best_loss = None
             best_x = None
 
-            # A function that updates the best loss and best input
+            # A function that updates the best loss and best input (in
+            # place, after the first call)
             def replace_best(loss, bloss, x, bx):
                 if bloss is None:
-                    bx = x.clone().detach()
-                    bloss = loss.clone().detach()
+                    bx = x.detach().clone()
+                    bloss = loss.detach().clone()
                 else:
                     replace = m * bloss < m * loss
-                    bx[replace] = x[replace].clone().detach()
-                    bloss[replace] = loss[replace]
+                    ch.where(replace, loss.detach(), bloss, out=bloss)
+                    replace = replace.view(-1, *([1] * (len(x.shape) - 1)))
+                    ch.where(replace, x.detach(), bx, out=bx)
 
                 return bloss, bx
 
+            # With track_best, also keep the success of the best input (so
+            # that restarts can be compared without evaluating them again);
+            # must be called before replace_best updates bloss
+            best_success = None
+            def replace_success(success, loss, bloss, bsuccess):
+                if success is None or bloss is None or not use_best:
+                    return success
+                return ch.where(m * bloss < m * loss, success, bsuccess)
+
+            # With early stopping (or query budgets), finished examples are
+            # written into the full-size output and dropped from the working
+            # batch; `active` maps rows of the working batch back to rows of
+            # the output
+            n = x.shape[0]
+            compact = bool(early_stop) or (query_budget is not None)
+            iters_used = ch.full((n,), iterations, dtype=ch.long, device=x.device)
+            if compact:
+                active = ch.arange(n, device=x.device)
+                final_x = x.clone().detach()
+                if track_best:
+                    final_loss = ch.zeros(n, device=x.device)
+                    final_success = ch.zeros(n, dtype=ch.bool, device=x.device)
+
+            # Model queries per example: each iteration costs one forward
+            # pass, plus the finite-difference queries if estimating the
+            # gradient
+            queries = ch.zeros(n, dtype=ch.long, device=x.device)
+            iter_cost = 1
+            if step.use_grad and est_grad is not None:
+                iter_cost += 2 * (est_grad[1] // 2)
+
+            # Convergence traces (kept on the device in compact form), with
+            # a last column for the final iterate
+            if trace:
+                loss_trace = ch.full((n, iterations + 1), float('nan'),
+                                     dtype=ch.float16, device=x.device)
+                first_success = ch.full((n,), -1, dtype=ch.long, device=x.device)
+
+                def record_trace(losses, out, target, it):
+                    rows = active if compact else slice(None)
+                    loss_trace[rows, it] = losses.detach().to(ch.float16)
+                    success = _attack_success(out, target, targeted)
+                    if success is not None:
+                        fs = first_success[rows]
+                        first_success[rows] = ch.where(success & (fs < 0),
+                                                       ch.full_like(fs, it), fs)
+
+            # The iterate lives in a single buffer that every step and
+            # projection updates in place
+            x = x.detach().clone().requires_grad_(True)
+
             # PGD iterates
-            for _ in iterator:
-                x = x.clone().detach().requires_grad_(True)
-                losses, out = calc_loss(step.to_image(x), target)
+            for it in iterator:
+                if profiler is not None: profiler.iteration = it
+                with phase('forward'):
+                    losses, out = calc_loss(step.to_image(x), target)
                 assert losses.shape[0] == x.shape[0], \
                         'Shape of losses must match input!'
 
-                loss = ch.mean(losses)
+                # Sum / (full batch size) rather than mean, so that the
+                # per-example gradient scale does not depend on how many
+                # examples are still active (or on restart tiling)
+                loss = ch.sum(losses) / loss_divisor
 
-                if step.use_grad:
-                    if (est_grad is None) and mixed_precision:
-                        with amp.scale_loss(loss, []) as sl:
-                            sl.backward()
-                        grad = x.grad.detach()
-                        x.grad.zero_()
-                    elif (est_grad is None):
-                        grad, = ch.autograd.grad(m * loss, [x])
+                with phase('backward'):
+                    if step.use_grad:
+                        if est_grad is None:
+                            # Scale the loss so that float16 gradients do
+                            # not underflow
+                            grad, = ch.autograd.grad(m * loss * loss_scale, [x])
+                            if loss_scale != 1: grad /= loss_scale
+                        else:
+                            if query_pool is not None:
+                                f = lambda _x, _y: m * query_pool(step.to_image(_x), _y,
+                                                                  should_normalize)
+                            else:
+                                f = lambda _x, _y: m * calc_loss(step.to_image(_x), _y)[0]
+                            grad = helpers.calc_est_grad(f, x, target, *est_grad)
                     else:
-                        f = lambda _x, _y: m * calc_loss(step.to_image(_x), _y)[0]
-                        grad = helpers.calc_est_grad(f, x, target, *est_grad)
-                else:
-                    grad = None
+                        grad = None
 
                 with ch.no_grad():
-                    args = [losses, best_loss, x, best_x]
-                    best_loss, best_x = replace_best(*args) if use_best else (losses, x)
+                    with phase('best'):
+                        # Let the step see the loss history (e.g. for APGD)
+                        step.observe(x, m * losses.detach(), it, iterations)
+
+                        if track_best:
+                            success = _attack_success(out, target, targeted)
+                            best_success = replace_success(success, losses,
+                                                           best_loss, best_success)
+                        args = [losses, best_loss, x, best_x]
+                        best_loss, best_x = replace_best(*args) if use_best else (losses, x)
 
-                    x = step.step(x, grad)
-                    x = step.project(x)
+                        if trace: record_trace(losses, out, target, it)
+
+                        if compact:
+                            queries[active] += iter_cost
+                            # Drop examples that are done (successful examples
+                            # keep the current iterate, out-of-budget ones their
+                            # best iterate so far)
+                            done = ch.zeros_like(active, dtype=ch.bool)
+                            if early_stop:
+                                done = is_done(out, target)
+                            if query_budget is not None:
+                                out_of_budget = queries[active] + iter_cost > query_budget
+                                use_x = done | ~out_of_budget
+                                to_ret = ch.where(use_x.view(
+                                    -1, *([1] * (len(x.shape) - 1))), x, best_x)
+                                done = done | out_of_budget
+                            else:
+                                use_x = ch.ones_like(done)
+                                to_ret = x
+                            if done.any():
+                                final_x[active[done]] = to_ret[done].detach()
+                                if track_best:
+                                    rows = active[done]
+                                    final_loss[rows] = ch.where(use_x, losses.detach(),
+                                                                best_loss)[done]
+                                    if best_success is not None:
+                                        final_success[rows] = ch.where(
+                                            use_x, success, best_success)[done]
+                                iters_used[active[done]] = it
+                                keep = ~done
+                                active, target = active[keep], target[keep]
+                                x = x[keep].requires_grad_(True)
+                                grad = grad[keep] if grad is not None else None
+                                best_loss, best_x = best_loss[keep], best_x[keep]
+                                if best_success is not None:
+                                    best_success = best_success[keep]
+                                step.select(keep)
+                                if active.shape[0] == 0: break
+                        else:
+                            queries += iter_cost
+
+                    if profiler is None:
+                        step.step_and_project_(x, grad)
+                    else:
+                        with phase('step'):
+                            step.step_(x, grad)
+                        with phase('project'):
+                            step.project_(x)
                     if do_tqdm: iterator.set_description("Current loss: {l}".format(l=loss))
 
             # Save computation (don't compute last loss) if not use_best
-            if not use_best: 
+            # (unless tracing the final iterate or tracking the best loss)
+            if not (use_best or trace or track_best) or \
+                    (compact and active.shape[0] == 0):
                 ret = x.clone().detach()
-                return step.to_image(ret) if return_image else ret
+            else:
+                if profiler is not None: profiler.iteration = iterations
+                with phase('forward'):
+                    losses, out = calc_loss(step.to_image(x), target)
+                queries[active if compact else slice(None)] += 1
+                with ch.no_grad(), phase('best'):
+                    if trace: record_trace(losses, out, target, iterations)
+                    if track_best:
+                        success = _attack_success(out, target, targeted)
+                        best_success = replace_success(success, losses,
+                                                       best_loss, best_success)
+                    if use_best:
+                        args = [losses, best_loss, x, best_x]
+                        best_loss, ret = replace_best(*args)
+                    else:
+                        best_loss, ret = losses.detach(), x.clone().detach()
+
+            stats = {'iterations': iters_used, 'queries': queries}
+            if track_best:
+                if compact:
+                    if active.shape[0] > 0:
+                        final_loss[active] = best_loss
+                        if best_success is not None:
+                            final_success[active] = best_success
+                    stats['final_loss'] = final_loss
+                    if best_success is not None:
+                        stats['final_success'] = final_success
+                else:
+                    stats['final_loss'] = best_loss
+                    if best_success is not None:
+                        stats['final_success'] = best_success
 
-            losses, _ = calc_loss(step.to_image(x), target)
-            args = [losses, best_loss, x, best_x]
-            best_loss, best_x = replace_best(*args)
-            return step.to_image(best_x) if return_image else best_x
+            if compact:
+                final_x[active] = ret
+                ret = final_x
+            ret = step.to_image(ret) if return_image else ret
+            if trace:
+                stats['loss_trace'] = loss_trace
+                stats['first_success'] = first_success
+            return ret, stats
+
+        # Decision-based attacks only look at the predicted labels, and run
+        # their own query loop
+        if getattr(step, 'decision_based', False):
+            if trace:
+                raise ValueError("trace is not supported by decision-based "
+                                 "attacks")
+
+            def is_adv(inp, target):
+                with ch.no_grad():
+                    _, output = calc_loss(inp, target)
+                success = _attack_success(output, target, targeted)
+                if success is None:
+                    raise ValueError("decision-based attacks require the loss "
+                                     "to return logits")
+                return success
+
+            adv_ret, info = self._decision_attack(x, target, step, is_adv,
+                                                  iterations, query_budget,
+                                                  early_stop, do_tqdm)
+            return (adv_ret, info) if return_info else adv_ret
+
+        # Random search attacks only look at the loss, and run their own
+        # query loop (one forward pass per iteration, no backward pass)
+        if getattr(step, 'random_search', False):
+            if trace:
+                raise ValueError("trace is not supported by random search "
+                                 "attacks")
+
+            def objective(inp, target):
+                with ch.no_grad():
+                    losses, output = calc_loss(inp, target)
+                done = is_done(output, target) if early_stop else None
+                return m * losses, done
+
+            adv_ret, info = self._random_search_attack(x, target, step,
+                                                       objective, iterations,
+                                                       query_budget, do_tqdm)
+            return (adv_ret, info) if return_info else adv_ret
+
+        # The query budget is split evenly between restarts (the attacks
+        # above ignore restarts and get the whole budget)
+        if query_budget is not None and random_restarts:
+            query_budget = query_budget // int(random_restarts)
 
         # Random restarts: repeat the attack and find the worst-case
         # example for each input in the batch
-        if random_restarts:
+        if random_restarts and batched_restarts:
+            R, B = int(random_restarts), x.shape[0]
+            with phase('restarts'):
+                tiled_x, tiled_target = _tile(x.detach(), R), _tile(target, R)
+                tiled_step = make_step(_tile(orig_input, R))
+            adv, stats = get_adv_examples(tiled_x, tiled_step, tiled_target,
+                                          track_best=True)
+            final_loss = stats.pop('final_loss')
+            final_success = stats.pop('final_success', None)
+            info = {k: v.view(R, B, *v.shape[1:]).transpose(0, 1)
+                    for k, v in stats.items()}
+            info['iterations'] = info['iterations'].sum(dim=1)
+            info['queries'] = info['queries'].sum(dim=1)
+
+            # Reduce to the worst-case restart for each input (successful
+            # restarts first, then highest loss), from the losses computed
+            # by the attack and without leaving the device
+            if profiler is not None: profiler.iteration = None
+            with ch.no_grad(), phase('restarts'):
+                score = m * final_loss
+                if final_success is not None:
+                    score = ch.where(final_success, ch.full_like(score, float('inf')), score)
+                best = score.view(R, B).argmax(dim=0)
+                adv_ret = adv[best * B + ch.arange(B, device=best.device)]
+        elif random_restarts:
             to_ret = None
+            all_stats = []
 
             orig_cpy = x.clone().detach()
             for _ in range(random_restarts):
-                adv = get_adv_examples(orig_cpy)
+                step = make_step(orig_input)
+                adv, stats = get_adv_examples(orig_cpy, step, target,
+                                              track_best=True)
+                stats.pop('final_loss')
+                success = stats.pop('final_success', None)
+                all_stats.append(stats)
 
-                if to_ret is None:
-                    to_ret = adv.detach()
+                if profiler is not None: profiler.iteration = None
+                with phase('restarts'):
+                    if to_ret is None:
+                        to_ret = adv.detach()
 
-                _, output = calc_loss(adv, target)
-                corr, = helpers.accuracy(output, target, topk=(1,), exact=True)
-                corr = corr.byte()
-                misclass = ~corr
-                to_ret[misclass] = adv[misclass]
+                    # Keep the successful restarts (known from the attack;
+                    # if the loss does not return logits, evaluate the
+                    # misclassification, counting the extra query)
+                    if success is None:
+                        _, output = calc_loss(adv, target)
+                        corr, = helpers.accuracy(output, target, topk=(1,), exact=True)
+                        success = ~corr.bool()
+                        stats['queries'] += 1
+                    to_ret[success] = adv[success]
 
             adv_ret = to_ret
+            info = {k: ch.stack([st[k] for st in all_stats], dim=1)
+                    for k in all_stats[0]}
+            info['iterations'] = info['iterations'].sum(dim=1)
+            info['queries'] = info['queries'].sum(dim=1)
         else:
-            adv_ret = get_adv_examples(x)
+            adv_ret, info = get_adv_examples(x, step, target)
+            if trace:
+                info['loss_trace'] = info['loss_trace'][:, None]
+                info['first_success'] = info['first_success'][:, None]
 
+        if return_info:
+            return adv_ret, info
         return adv_ret
 
+    def _decision_attack(self, x, target, step, is_adv, iterations,
+                         query_budget, early_stop, do_tqdm):
+        """
+        Query loop of decision-based attacks (see
+        :class:`~robustness.attack_steps.HopSkipJumpStep`). All queries are
+        batched over the examples that still need them, and each example
+        stops as soon as its next iteration could exceed
+        :samp:`query_budget` (or, with :samp:`early_stop`, once it is within
+        :samp:`eps`).
+
+        Returns:
+            The adversarial examples (projected onto the threat model) and
+            the info dictionary (see :samp:`return_info` in :meth:`forward`).
+        """
+        B = x.shape[0]
+        orig = step.orig_input
+        queries = ch.zeros(B, dtype=ch.long, device=x.device)
+        iters_used = ch.zeros(B, dtype=ch.long, device=x.device)
+        budget = float('inf') if query_budget is None else query_budget
+        theta = step.theta(x)
+
+        def query(inp, idx):
+            queries[idx] += 1
+            return is_adv(inp, target[idx])
+
+        def binary_search(x_adv, idx):
+            # Batched bisection on the blending coefficient between the
+            # original inputs (t = 0) and adversarial points (t = 1)
+            low = ch.zeros(idx.shape[0], device=x.device)
+            high = ch.ones(idx.shape[0], device=x.device)
+            for _ in range(step.max_bs_steps):
+                busy = ((high - low) > theta).nonzero().flatten()
+                if busy.shape[0] == 0: break
+                mid = (high[busy] + low[busy]) / 2
+                ok = query(step.blend(orig[idx[busy]], x_adv[busy], mid), idx[busy])
+                high[busy] = ch.where(ok, mid, high[busy])
+                low[busy] = ch.where(ok, low[busy], mid)
+            return step.blend(orig[idx], x_adv, high)
+
+        with ch.no_grad():
+            # Find an adversarial starting point: the input itself, or
+            # uniform noise (only while the binary search that follows still
+            # fits in the query budget)
+            adv = x.detach().clone()
+            if budget < 1:
+                return step.project(adv), {'iterations': iters_used,
+                                           'queries': queries}
+            found = query(adv, ch.arange(B, device=x.device))
+            for _ in range(step.init_attempts):
+                idx = (~found & (queries + 1 + step.max_bs_steps <= budget))
+                idx = idx.nonzero().flatten()
+                if idx.shape[0] == 0: break
+                cand = ch.rand_like(adv[idx])
+                ok = query(cand, idx)
+                adv[idx[ok]] = cand[ok]
+                found[idx[ok]] = True
+
+            # Examples that are already adversarial at the original input
+            # are done (distance 0, nothing to search)
+            dist = step.distance(orig, adv)
+            idx = (found & (dist > 0) & (queries + step.max_bs_steps <= budget))
+            idx = idx.nonzero().flatten()
+            if idx.shape[0] > 0:
+                adv[idx] = binary_search(adv[idx], idx)
+            dist = step.distance(orig, adv)
+
+            iterator = range(iterations)
+            if do_tqdm: iterator = tqdm(iterator)
+            for it in iterator:
+                num_evals = int(min(step.init_evals * (it + 1) ** 0.5, step.max_evals))
+                cost = num_evals + step.max_halvings + step.max_bs_steps
+                active = found & (dist > 0) & (queries + cost <= budget)
+                if early_stop: active &= dist > step.eps
+                idx = active.nonzero().flatten()
+                if idx.shape[0] == 0: break
+                x_b, n = adv[idx], idx.shape[0]
+                ext = [1] * (len(x.shape) - 1)
+
+                # Estimate the gradient direction at the boundary from the
+                # labels of random queries, streamed in chunks of at most
+                # (roughly) one batch of queries, with a baseline subtracted
+                # from the labels
+                delta = step.delta(x_b, dist[idx], it).view(-1, *ext)
+                chunk = max(1, B // n)
+                sum_fu, sum_u = ch.zeros_like(x_b), ch.zeros_like(x_b)
+                sum_f = ch.zeros(n, device=x.device)
+                for start in range(0, num_evals, chunk):
+                    k = min(chunk, num_evals - start)
+                    u = step.random_directions(x_b, k)
+                    cand = ch.clamp(x_b + delta * u, 0, 1)
+                    delta_u = (cand - x_b) / delta
+                    f = is_adv(cand.flatten(0, 1), target[idx].repeat(k)).view(k, n)
+                    f = 2 * f.float() - 1
+                    sum_fu += (f.view(k, n, *ext) * delta_u).sum(dim=0)
+                    sum_u += delta_u.sum(dim=0)
+                    sum_f += f.sum(dim=0)
+                queries[idx] += num_evals
+                f_mean = (sum_f / num_evals).view(-1, *ext)
+                grad = sum_fu / num_evals
+                baseline = (f_mean.abs() < 1).to(grad.dtype)
+                grad = grad - baseline * f_mean * sum_u / num_evals
+                v = step.update_direction(grad)
+
+                # Geometric step size search: halve the step until the
+                # point is still adversarial
+                size = step.initial_step_size(dist[idx], it)
+                pending = ch.arange(n, device=x.device)
+                for _ in range(step.max_halvings):
+                    cand = ch.clamp(x_b[pending] + size[pending].view(-1, *ext)
+                                    * v[pending], 0, 1)
+                    ok = query(cand, idx[pending])
+                    size[pending[~ok]] /= 2
+                    pending = pending[~ok]
+                    if pending.shape[0] == 0: break
+                moved = ch.ones(n, dtype=ch.bool, device=x.device)
+                moved[pending] = False
+
+                # Back to the boundary, keeping the new point if it is closer
+                if moved.any():
+                    m_idx = idx[moved]
+                    cand = ch.clamp(x_b[moved] + size[moved].view(-1, *ext)
+                                    * v[moved], 0, 1)
+                    cand = binary_search(cand, m_idx)
+                    new_dist = step.distance(orig[m_idx], cand)
+                    closer = new_dist < dist[m_idx]
+                    adv[m_idx[closer]] = cand[closer]
+                    dist[m_idx[closer]] = new_dist[closer]
+                iters_used[idx] += 1
+                if do_tqdm:
+                    iterator.set_description(f"Median distance: {dist.median():.4f}")
+
+            # Examples without an adversarial starting point stay unchanged
+            adv[~found] = x[~found]
+            adv = step.project(adv)
+        return adv, {'iterations': iters_used, 'queries': queries}
+
+    def _random_search_attack(self, x, target, step, objective, iterations,
+                              query_budget, do_tqdm):
+        """
+        Query loop of random search attacks (see
+        :class:`~robustness.attack_steps.SquareStep`). Every iteration
+        evaluates one proposal per example in a single batched forward pass,
+        and keeps it for the examples whose objective improves. Examples stop
+        once they are done (see :samp:`early_stop` in :meth:`forward`) or
+        once their next query would exceed :samp:`query_budget`.
+
+        Returns:
+            The adversarial examples and the info dictionary (see
+            :samp:`return_info` in :meth:`forward`).
+        """
+        if len(x.shape) != 4:
+            raise ValueError("random search attacks require N x C x H x W inputs")
+        B, _, h, w = x.shape
+        orig = step.orig_input
+        budget = float('inf') if query_budget is None else query_budget
+        iters_used = ch.zeros(B, dtype=ch.long, device=x.device)
+
+        with ch.no_grad():
+            # The start is projected, so that warm starts (x != orig_input)
+            # stay in the threat model
+            adv = step.project(step.random_perturb(x.detach()))
+            best_loss, done = objective(adv, target)
+            queries = ch.ones(B, dtype=ch.long, device=x.device)
+            if done is None:
+                done = ch.zeros(B, dtype=ch.bool, device=x.device)
+
+            iterator = range(iterations)
+            if do_tqdm: iterator = tqdm(iterator)
+            for it in iterator:
+                idx = (~done & (queries + 1 <= budget)).nonzero().flatten()
+                if idx.shape[0] == 0: break
+                s = step.square_size(it, iterations, h, w)
+                cand = step.propose(adv[idx], orig[idx], s)
+                loss, cand_done = objective(cand, target[idx])
+                queries[idx] += 1
+                iters_used[idx] += 1
+
+                # Keep the proposals that improve the objective
+                better = loss > best_loss[idx]
+                adv[idx[better]] = cand[better]
+                best_loss[idx[better]] = loss[better]
+                if cand_done is not None:
+                    done[idx[better]] = cand_done[better]
+                if do_tqdm:
+                    iterator.set_description(f"Mean loss: {best_loss.mean():.4f}")
+        return adv, {'iterations': iters_used, 'queries': queries}
+
+    def _multi_target_attack(self, x, target, chunk_size, **attack_kwargs):
+        """
+        Targeted attacks of each input towards each of its targets (see
+        :samp:`multi_target` in :meth:`forward`).
+        """
+        if not attack_kwargs['targeted']:
+            raise ValueError("multi_target requires targeted=True")
+        if not attack_kwargs['return_image']:
+            raise ValueError("multi_target requires return_image=True")
+        N, K = target.shape
+        orig_input = attack_kwargs.pop('orig_input')
+        return_info = attack_kwargs['return_info']
+        chunk_size = chunk_size or N * K
+        # Normalize the loss of every chunk by the full expanded batch
+        full_size = attack_kwargs.pop('loss_batch_size', None) or N
+        attack_kwargs['loss_batch_size'] = full_size * K
+
+        flat_target = target.reshape(-1)
+        adv, success, infos = None, [], []
+        for start in range(0, N * K, chunk_size):
+            idx = ch.arange(start, min(start + chunk_size, N * K),
+                            device=target.device)
+            inp_idx = (idx // K).to(x.device)
+            chunk_orig = None if orig_input is None else \
+                         orig_input[inp_idx.to(orig_input.device)]
+            ret = self.forward(x[inp_idx], flat_target[idx],
+                               orig_input=chunk_orig, **attack_kwargs)
+            chunk_adv = ret[0] if return_info else ret
+            if return_info: infos.append(ret[1])
+            if adv is None:
+                adv = ch.empty(N * K, *chunk_adv.shape[1:], dtype=chunk_adv.dtype,
+                               device=chunk_adv.device)
+            adv[start:start + chunk_adv.shape[0]] = chunk_adv.detach()
+
+            with ch.no_grad():
+                inp = self.normalize(chunk_adv) if attack_kwargs['should_normalize'] \
+                      else chunk_adv
+                output = self.model(inp)
+                success.append(output.argmax(dim=1) == flat_target[idx].to(output.device))
+
+        adv = adv.view(N, K, *adv.shape[1:])
+        success = ch.cat(success).view(N, K)
+        if return_info:
+            info = {k: ch.cat([i[k] for i in infos]) for k in infos[0]}
+            info = {k: v.view(N, K, *v.shape[1:]) for k, v in info.items()}
+            return adv, success, info
+        return adv, success
+
 class AttackerModel(ch.nn.Module):
     """
     Wrapper class for adversarial attacks on models. Given any normal
@@ -268,14 +973,16 @@ class AttackerModel(ch.nn.Module):
     For a more comprehensive overview of this class, see 
     :doc:`our detailed walkthrough <../example_usage/input_space_manipulation>`.
     """
-    def __init__(self, model, dataset):
+    def __init__(self, model, dataset, device=None):
         super(AttackerModel, self).__init__()
         self.normalizer = helpers.InputNormalize(dataset.mean, dataset.std)
         self.model = model
-        self.attacker = Attacker(model, dataset)
+        self.device = device
+        self.attacker = Attacker(model, dataset, device=device)
 
     def forward(self, inp, target=None, make_adv=False, with_latent=False,
-                fake_relu=False, no_relu=False, with_image=True, **attacker_kwargs):
+                fake_relu=False, no_relu=False, with_image=True,
+                max_attack_batch=None, **attacker_kwargs):
         """
         Main function for running inference and generating adversarial
         examples for a model.
@@ -304,16 +1011,50 @@ class AttackerModel(ch.nn.Module):
                 visible effect without :samp:`with_latent=True`.
             with_image (bool) : if :samp:`False`, only return the model output
                 (even if :samp:`make_adv == True`).
+            max_attack_batch (int|None) : if given, attack the input in
+                micro-batches of at most this many examples (one after
+                another, to bound the memory of the attack), and put the
+                results back together into a full batch. The attack loss is
+                still normalized by the full batch size (see
+                :samp:`loss_batch_size` in
+                :meth:`robustness.attacker.Attacker.forward`), so every
+                example takes the same steps as in the full batch; only the
+                random draws (random starts, gradient estimation noise)
+                differ, so the results are equal in distribution rather than
+                identical.
+            attacker_kwargs : arguments for the adversarial attack, see
+                :meth:`robustness.attacker.Attacker.forward`. Additionally,
+                :samp:`cache` can be a
+                :class:`~robustness.tools.adv_cache.AdvCache`, in which case
+                adversarial examples found in the cache are reused and only
+                the remaining inputs are attacked. If
+                :samp:`make_adv` and :samp:`return_info` are both True, the
+                attack information dictionary is appended to the returned
+                tuple, e.g. :samp:`(model_logits, adv_input, attack_info)`.
+                With :samp:`multi_target`, the result of the attack (see
+                :meth:`robustness.attacker.Attacker.forward`) is returned as
+                is.
 
         """
         if make_adv:
             assert target is not None
             prev_training = bool(self.training)
             self.eval()
-            adv = self.attacker(inp, target, **attacker_kwargs)
+            if max_attack_batch is None or inp.shape[0] <= max_attack_batch:
+                adv = self._attack(inp, target, **attacker_kwargs)
+            else:
+                adv = self._micro_batched_attack(inp, target, max_attack_batch,
+                                                 **attacker_kwargs)
             if prev_training:
                 self.train()
 
+            # Multi-target attacks return their own results (see
+            # Attacker.forward)
+            if attacker_kwargs.get('multi_target', False):
+                return adv
+
+            if attacker_kwargs.get('return_info', False):
+                adv, attack_info = adv
             inp = adv
 
         normalized_inp = self.normalizer(inp)
@@ -325,6 +1066,139 @@ class AttackerModel(ch.nn.Module):
 
         output = self.model(normalized_inp, with_latent=with_latent,
                                 fake_relu=fake_relu, no_relu=no_relu)
-        if with_image:
-            return (output, inp)
-        return output
+        ret = (output, inp) if with_image else (output,)
+        if make_adv and attacker_kwargs.get('return_info', False):
+            ret = ret + (attack_info,)
+        return ret if len(ret) > 1 else output
+
+    def _micro_batched_attack(self, inp, target, max_batch, **attacker_kwargs):
+        """
+        Runs :meth:`_attack` on micro-batches of at most :samp:`max_batch`
+        examples and concatenates the results (see :meth:`forward`).
+        """
+        orig_input = attacker_kwargs.pop('orig_input', None)
+        attacker_kwargs.setdefault('loss_batch_size', inp.shape[0])
+        rets = []
+        for start in range(0, inp.shape[0], max_batch):
+            sl = slice(start, start + max_batch)
+            chunk_orig = None if orig_input is None else orig_input[sl]
+            rets.append(self._attack(inp[sl], target[sl], orig_input=chunk_orig,
+                                     **attacker_kwargs))
+        return _cat_results(rets)
+
+    def _attack(self, inp, target, cache=None, **attacker_kwargs):
+        """
+        Runs the attacker, serving whatever it can from :samp:`cache` (see
+        :meth:`forward`).
+        """
+        if cache is None or not adv_cache.is_cacheable(attacker_kwargs):
+            return self.attacker(inp, target, **attacker_kwargs)
+
+        keys = cache.keys(inp, target, attacker_kwargs)
+        hit, delta = cache.get(keys)
+        adv = inp.detach().clone()
+        if delta is not None:
+            adv[hit.to(adv.device)] += delta.to(adv.device, adv.dtype)
+        miss = (~hit).nonzero().flatten().tolist()
+        if miss:
+            miss_idx = ch.tensor(miss, device=adv.device)
+            new_adv = self.attacker(inp[miss_idx], target[miss_idx],
+                                    **attacker_kwargs)
+            adv[miss_idx] = new_adv.to(adv.dtype)
+            cache.put([keys[i] for i in miss],
+                      new_adv - inp[miss_idx].to(new_adv.device))
+        return adv
+
+def certify(model, x, sigma, n0=100, n=100000, alpha=0.001, batch_size=1000):
+    """
+    Certifies the predictions of the randomized-smoothing classifier
+    :math:`g(x) = \\arg\\max_c P(f(x + \\delta) = c)`,
+    :math:`\\delta \\sim \\mathcal{N}(0, \\sigma^2 I)`, on a batch of inputs
+    (the CERTIFY procedure of [CRK19]_).
+
+    For each input, the top class is selected from :samp:`n0` noise samples,
+    and its probability is lower-bounded (one-sided Clopper-Pearson, at level
+    :samp:`1 - alpha`) from a separate set of :samp:`n` noise samples. Noisy
+    copies of all the inputs are drawn and classified together, in chunks of
+    :samp:`batch_size`, and only the per-class vote counts are kept, so
+    memory does not depend on :samp:`n0` or :samp:`n`.
+
+    Args:
+        model (AttackerModel) : the base classifier :math:`f` (may be wrapped
+            in ``DataParallel``)
+        x (ch.tensor) : inputs to certify (images in :math:`[0, 1]`)
+        sigma (float) : standard deviation of the (image space) noise. The
+            noisy images are normalized but *not* clipped to :math:`[0, 1]`.
+        n0 (int) : number of noise samples per input for selecting the class
+        n (int) : number of noise samples per input for estimating its
+            probability
+        alpha (float) : failure probability of the certificate
+        batch_size (int) : number of noisy images per forward pass
+
+    Returns:
+        A tuple :samp:`(prediction, radius)` of tensors of size N: the
+        predicted class (-1 if the smoothed classifier abstains) and the
+        certified :math:`\\ell_2` radius (0 when abstaining).
+
+    .. [CRK19] Cohen, Rosenfeld and Kolter, "Certified Adversarial Robustness
+        via Randomized Smoothing", 2019.
+    """
+    from scipy.stats import beta, norm
+
+    attacker_model = model.module if hasattr(model, 'module') else model
+    prev_training = bool(model.training)
+    model.eval()
+    with ch.no_grad():
+        counts0 = _smoothed_votes(model, attacker_model, x, sigma, n0, batch_size)
+        top = counts0.argmax(dim=1)
+        counts = _smoothed_votes(model, attacker_model, x, sigma, n, batch_size,
+                                 num_classes=counts0.shape[1])
+    if prev_training:
+        model.train()
+
+    n_top = counts.gather(1, top[:, None]).squeeze(1).cpu().numpy()
+    p_lower = beta.ppf(alpha, n_top, n - n_top + 1)
+    p_lower[n_top == 0] = 0.
+    p_lower = ch.from_numpy(p_lower).to(x.device)
+
+    certified = p_lower >= 0.5
+    prediction = ch.where(certified, top, ch.full_like(top, -1))
+    radius = sigma * ch.from_numpy(norm.ppf(p_lower.cpu().numpy())).to(x.device)
+    radius = ch.where(certified, radius, ch.zeros_like(radius)).float()
+    return prediction, radius
+
+def _smoothed_votes(model, attacker_model, x, sigma, num_samples, batch_size,
+                    num_classes=None):
+    """
+    Per-class counts (N x num_classes) of the predictions of ``model`` on
+    ``num_samples`` noisy copies of each input. The N * num_samples noisy
+    images are enumerated input-major and classified ``batch_size`` at a
+    time, so chunks may span several inputs.
+    """
+    B = x.shape[0]
+    normalizer = attacker_model.normalizer
+    counts = None if num_classes is None else \
+             ch.zeros(B, num_classes, dtype=ch.long, device=x.device)
+    total = B * num_samples
+    for start in range(0, total, batch_size):
+        idx = ch.arange(start, min(start + batch_size, total), device=x.device)
+        inp_idx = idx // num_samples
+        noisy = x[inp_idx] + sigma * ch.randn_like(x[inp_idx])
+        noisy = (noisy - normalizer.new_mean) / normalizer.new_std
+        output = _model_output(model, attacker_model, noisy)
+        if counts is None:
+            counts = ch.zeros(B, output.shape[1], dtype=ch.long, device=x.device)
+        counts.index_put_((inp_idx, output.argmax(dim=1).to(x.device)),
+                          ch.ones_like(inp_idx), accumulate=True)
+    return counts
+
+def _model_output(model, attacker_model, normalized_inp):
+    """
+    Logits of the classifier inside an AttackerModel on already-normalized
+    inputs, going through ``DataParallel`` if ``model`` is wrapped in it.
+    """
+    if not isinstance(model, ch.nn.DataParallel):
+        return attacker_model.model(normalized_inp)
+    return ch.nn.parallel.data_parallel(attacker_model.model, normalized_inp,
+                                        device_ids=model.device_ids,
+                                        output_device=model.output_device)
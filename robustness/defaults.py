@@ -47,6 +47,12 @@ TRAINING_ARGS = [
     ['custom-lr-multiplier', str, 'LR multiplier sched (format: [(epoch, LR),...])', None],
     ['lr-interpolation', ["linear", "step"], 'Drop LR as step function or linearly', "step"],
     ['adv-train', [0, 1], 'whether to train adversarially', REQ],
+    ['adv-train-mode', ['pgd', 'free', 'fgsm_rs'], 'how to train adversarially', 'pgd'],
+    ['free-replays', int, 'number of replays per batch for free adv training', 4],
+    ['fgsm-step-mult', float, 'FGSM step size (multiple of eps) for fgsm_rs training', 1.25],
+    ['co-check', [0, 1], 'check for catastrophic overfitting (fgsm_rs only)', 0],
+    ['co-check-steps', int, 'PGD steps for the catastrophic overfitting check', 10],
+    ['co-threshold', float, 'robust acc. drop (%) that counts as catastrophic overfitting', 20.],
     ['adv-eval', [0, 1], 'whether to adversarially evaluate', None], 
     ['log-iters', int, 'how frequently (in epochs) to log', 5],
     ['save-ckpt-iters', int, 'how frequently (epochs) to save \
@@ -66,6 +72,16 @@ PGD_ARGS = [
     ['attack-lr', str, 'step size for PGD', REQ],
     ['use-best', [0, 1], 'if 1 (0) use best (final) PGD step as example', 1],
     ['random-restarts', int, 'number of random PGD restarts for eval', 0],
+    ['batched-restarts', [0, 1], 'run restarts as one batch (faster, more memory)', 0],
+    ['early-stop', [0, 1], 'stop attacking examples once misclassified (eval only)', 0],
+    ['compile-step', [0, 1], 'use compiled fused step+projection kernels', 0],
+    ['max-attack-batch', int, 'attack in micro-batches of at most this size', None],
+    ['profile-attack', [0, 1], 'profile time and memory of each attack phase', 0],
+    ['attack-trace', [0, 1], 'log attack convergence to the store (eval only)', 0],
+    ['resume-eval', [0, 1], 'save eval progress to the store and resume it (eval only)', 0],
+    ['eps-sweep', str, 'comma-separated increasing eps values to evaluate at (eval only)', None],
+    ['adv-cache-dir', str, 'directory to cache adversarial examples in (eval only)', None],
+    ['adv-cache-gb', float, 'maximum size of the adversarial example cache (GB)', 10],
     ['random-start', [0, 1], 'start with random noise instead of pgd step', 0],
     ['custom-eps-multiplier', str, 'eps mult. sched (same format as LR)', None]
 ]
@@ -87,6 +103,8 @@ MODEL_LOADER_ARGS = [
     ['resume-optimizer', [0, 1], 'whether to also resume optimizers', 0],
     ['data-aug', [0, 1], 'whether to use data augmentation', 1],
     ['mixed-precision', [0, 1], 'whether to use MP training (faster)', 0],
+    ['device', str, 'device to run on, e.g. cuda or cpu (None: cuda if available)', None],
+    ['cpu-threads', int, 'intra-op threads when running on CPU (None: # physical cores)', None],
 ]
 """
 Arguments essential for constructing the model and dataloaders that will be fed
@@ -41,13 +41,16 @@ def main(args, store=None):
     train_loader, val_loader = dataset.make_loaders(args.workers,
                     args.batch_size, data_aug=bool(args.data_aug))
 
-    train_loader = helpers.DataPrefetcher(train_loader)
-    val_loader = helpers.DataPrefetcher(val_loader)
+    device = helpers.get_device(args.device)
+    if device.type == 'cuda':
+        train_loader = helpers.DataPrefetcher(train_loader)
+        val_loader = helpers.DataPrefetcher(val_loader)
     loaders = (train_loader, val_loader)
 
     # MAKE MODEL
     model, checkpoint = make_and_restore_model(arch=args.arch,
-            dataset=dataset, resume_path=args.resume)
+            dataset=dataset, resume_path=args.resume, device=device,
+            cpu_threads=args.cpu_threads)
     if 'module' in dir(model): model = model.module
 
     print(args)
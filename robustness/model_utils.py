@@ -51,7 +51,8 @@ class DummyModel(nn.Module):
         return self.model(x)
 
 def make_and_restore_model(*_, arch, dataset, resume_path=None,
-         parallel=False, pytorch_pretrained=False, add_custom_forward=False):
+         parallel=False, pytorch_pretrained=False, add_custom_forward=False,
+         device=None, cpu_threads=None):
     """
     Makes a model and (optionally) restores it from a checkpoint.
 
@@ -63,7 +64,8 @@ def make_and_restore_model(*_, arch, dataset, resume_path=None,
             robustness library (ignored if ``arch`` is not a string)
         not a string
         parallel (bool): if True, wrap the model in a DataParallel 
-            (defaults to False)
+            (defaults to False; on the CPU, a
+            :class:`~robustness.tools.helpers.ModuleWrapper` instead)
         pytorch_pretrained (bool): if True, try to load a standard-trained 
             checkpoint from the torchvision library (throw error if failed)
         add_custom_forward (bool): ignored unless arch is an instance of
@@ -75,6 +77,11 @@ def make_and_restore_model(*_, arch, dataset, resume_path=None,
             not be passed to forward(). (Useful if you just want to train a
             model and don't care about these arguments, and are passing in an
             arch that you don't want to edit forward() for, e.g.  a pretrained model)
+        device (str|ch.device|None): device to put the model (and run
+            attacks) on. If ``None``, use CUDA if available and CPU otherwise.
+        cpu_threads (int|None): ignored unless running on CPU. Number of
+            intra-op threads to use; if ``None``, use one per physical core
+            (see :meth:`robustness.tools.helpers.set_cpu_threads`).
     Returns: 
         A tuple consisting of the model (possibly loaded with checkpoint), and the checkpoint itself
     """
@@ -84,13 +91,18 @@ def make_and_restore_model(*_, arch, dataset, resume_path=None,
     classifier_model = dataset.get_model(arch, pytorch_pretrained) if \
                             isinstance(arch, str) else arch
 
-    model = AttackerModel(classifier_model, dataset)
+    device = helpers.get_device(device)
+    if device.type == 'cpu':
+        helpers.set_cpu_threads(cpu_threads)
+
+    model = AttackerModel(classifier_model, dataset, device=device)
 
     # optionally resume from a checkpoint
     checkpoint = None
     if resume_path and os.path.isfile(resume_path):
         print("=> loading checkpoint '{}'".format(resume_path))
-        checkpoint = ch.load(resume_path, pickle_module=dill)
+        checkpoint = ch.load(resume_path, pickle_module=dill,
+                             map_location=device)
         
         # Makes us able to load models saved with legacy versions
         state_dict_path = 'model'
@@ -106,8 +118,8 @@ def make_and_restore_model(*_, arch, dataset, resume_path=None,
         raise ValueError(error_msg)
 
     if parallel:
-        model = ch.nn.DataParallel(model)
-    model = model.cuda()
+        model = helpers.data_parallel(model, device)
+    model = model.to(device)
 
     return model, checkpoint
 
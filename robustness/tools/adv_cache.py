@@ -0,0 +1,200 @@
+"""
+A persistent, size-bounded on-disk cache for adversarial examples, used to
+skip re-running attacks when the same model is evaluated with the same attack
+on the same inputs (e.g. re-running :meth:`robustness.train.eval_model`).
+
+Entries are keyed by (a hash of) the model weights, the attack configuration
+and the content of each input/label pair, and store the adversarial
+*perturbation* in a memory-mapped array with least-recently-used eviction.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch as ch
+
+from . import constants
+
+INDEX_NAME = 'index.pkl'
+DATA_NAME = 'perturbations.npy'
+
+def model_fingerprint(model):
+    """
+    Content hash of a model's weights (and buffers). Insensitive to
+    ``DataParallel`` wrapping.
+
+    Args:
+        model (ch.nn.Module) : the model to fingerprint
+
+    Returns:
+        A hex digest string.
+    """
+    h = hashlib.sha256()
+    for name, t in sorted(model.state_dict().items()):
+        if name.startswith('module.'): name = name[len('module.'):]
+        h.update(name.encode())
+        h.update(t.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+def attack_config(attacker_kwargs, seed=None):
+    """
+    The part of the attack arguments that determines the adversarial
+    examples (see :meth:`robustness.attacker.Attacker.forward`), as a string.
+    """
+    keys = [k for k in constants.ATTACK_KWARG_KEYS if k != 'criterion']
+    keys += ['targeted', 'use_best', 'est_grad', 'should_normalize',
+             'query_budget', 'early_stop', 'batched_restarts']
+    config = {k: attacker_kwargs.get(k) for k in keys}
+    constraint = config['constraint']
+    if not isinstance(constraint, str) and constraint is not None:
+        config['constraint'] = f'{constraint.__module__}.{constraint.__qualname__}'
+    config['seed'] = seed
+    return json.dumps(config, sort_keys=True, default=str)
+
+def is_cacheable(attacker_kwargs):
+    """
+    Whether an attack can be served from the cache: the perturbation set
+    must be centered on the input, the result must be a batch of images
+    (without attack info), and the loss must be the default one (custom
+    losses can't be reliably hashed).
+    """
+    return attacker_kwargs.get('orig_input') is None and \
+           attacker_kwargs.get('return_image', True) and \
+           attacker_kwargs.get('custom_loss') is None and \
+           not attacker_kwargs.get('return_info', False) and \
+           not attacker_kwargs.get('multi_target', False)
+
+class AdvCache:
+    """
+    On-disk LRU cache mapping (model, attack, input) to adversarial
+    perturbations.
+
+    Args:
+        path (str) : directory to keep the cache in (created if needed, and
+            re-opened if it already exists)
+        max_bytes (int) : upper bound on the size of the stored perturbations
+        namespace (str) : identifier for the model being attacked, usually
+            :meth:`model_fingerprint` of the model
+        seed (int|None) : included in the keys, to keep results of randomized
+            attacks with different seeds apart
+        dtype (np.dtype) : dtype to store perturbations in
+    """
+    def __init__(self, path, max_bytes, namespace, seed=None, dtype=np.float32):
+        self.path = path
+        self.max_bytes = int(max_bytes)
+        self.namespace = namespace
+        self.seed = seed
+        self.dtype = np.dtype(dtype)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(path, exist_ok=True)
+        self.data = None
+        index_path = os.path.join(path, INDEX_NAME)
+        if os.path.isfile(index_path):
+            with open(index_path, 'rb') as f:
+                self.index = pickle.load(f)
+            self.dtype = np.dtype(self.index['dtype'])
+            if self.index['shape'] is not None: self._open_data(mode='r+')
+        else:
+            # slots: key -> slot, ordered from least to most recently used
+            self.index = {'shape': None, 'dtype': self.dtype.str,
+                          'capacity': 0, 'slots': OrderedDict(), 'free': []}
+
+    def _open_data(self, mode):
+        shape = (self.index['capacity'],) + tuple(self.index['shape'])
+        self.data = np.lib.format.open_memmap(os.path.join(self.path, DATA_NAME),
+                        mode=mode, dtype=np.dtype(self.index['dtype']),
+                        shape=shape if mode == 'w+' else None)
+
+    def _init_storage(self, example_shape):
+        example_bytes = int(np.prod(example_shape)) * self.dtype.itemsize
+        capacity = self.max_bytes // example_bytes
+        if capacity == 0:
+            raise ValueError(f'max_bytes={self.max_bytes} is too small to '
+                             f'cache a single example of shape {example_shape}')
+        self.index.update({'shape': tuple(example_shape), 'capacity': capacity,
+                           'free': list(range(capacity - 1, -1, -1))})
+        self._open_data(mode='w+')
+
+    def keys(self, x, target, attacker_kwargs):
+        """
+        Cache keys for each (input, label) pair in a batch.
+
+        Returns:
+            A list of N hex digest strings.
+        """
+        prefix = hashlib.sha256()
+        prefix.update(self.namespace.encode())
+        prefix.update(attack_config(attacker_kwargs, self.seed).encode())
+        xs = x.detach().cpu().contiguous().numpy()
+        ys = target.detach().cpu().contiguous().numpy()
+        keys = []
+        for xi, yi in zip(xs, ys):
+            h = prefix.copy()
+            h.update(xi.tobytes())
+            h.update(yi.tobytes())
+            keys.append(h.hexdigest())
+        return keys
+
+    def get(self, keys):
+        """
+        Look up perturbations for a list of keys.
+
+        Returns:
+            A tuple :samp:`(hit, delta)` where :samp:`hit` is a boolean
+            tensor of size N and :samp:`delta` holds the perturbations for the
+            hits (in order), or is None if there are no hits.
+        """
+        with self.lock:
+            slots = self.index['slots']
+            found = [slots.get(k) for k in keys]
+            for k, slot in zip(keys, found):
+                if slot is not None: slots.move_to_end(k)
+            hit = ch.tensor([slot is not None for slot in found], dtype=ch.bool)
+            num_hits = int(hit.sum())
+            self.hits += num_hits
+            self.misses += len(keys) - num_hits
+            if num_hits == 0:
+                return hit, None
+            delta = self.data[[slot for slot in found if slot is not None]]
+            return hit, ch.from_numpy(np.array(delta, dtype=np.float32))
+
+    def put(self, keys, delta):
+        """
+        Store perturbations for a list of keys (evicting the least recently
+        used entries if the cache is full), and flush the cache to disk.
+        """
+        delta = delta.detach().cpu().numpy().astype(self.dtype)
+        with self.lock:
+            if self.index['shape'] is None:
+                self._init_storage(delta.shape[1:])
+            if tuple(delta.shape[1:]) != tuple(self.index['shape']):
+                raise ValueError(f"cache at {self.path} holds examples of shape "
+                                 f"{self.index['shape']}, got {delta.shape[1:]}")
+            slots, free = self.index['slots'], self.index['free']
+            for k, d in zip(keys, delta):
+                if k in slots:
+                    slot = slots[k]
+                    slots.move_to_end(k)
+                else:
+                    slot = free.pop() if free else slots.popitem(last=False)[1]
+                    slots[k] = slot
+                self.data[slot] = d
+            self._flush()
+
+    def _flush(self):
+        self.data.flush()
+        index_path = os.path.join(self.path, INDEX_NAME)
+        with open(index_path + '.tmp', 'wb') as f:
+            pickle.dump(self.index, f)
+        os.replace(index_path + '.tmp', index_path)
+
+    def __len__(self):
+        return len(self.index['slots'])
@@ -0,0 +1,140 @@
+"""
+Opt-in profiling of adversarial attacks. Pass an :class:`AttackProfiler` as
+:samp:`profiler` to :meth:`robustness.attacker.Attacker.forward` (via
+:class:`~robustness.attacker.AttackerModel`) to record the wall time and
+memory use of every phase of every attack iteration::
+
+    profiler = AttackProfiler()
+    _, adv = model(x, y, make_adv=True, profiler=profiler, **attack_kwargs)
+    print(profiler.summary())
+
+The phases are:
+
+- ``forward``: computing the attack loss
+- ``backward``: computing (or estimating) its gradient
+- ``step``: the gradient step
+- ``project``: the projection onto the threat model
+- ``best``: keeping track of the best iterate (and early stopping)
+- ``restarts``: the bookkeeping for random restarts (tiling the inputs and
+  selecting the best restart)
+
+With a profiler attached, the step and the projection run as two separate
+operations (so that they can be timed), even if :samp:`compile_step` is set.
+"""
+
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import psutil
+import torch as ch
+
+from . import constants
+
+PHASES = ['forward', 'backward', 'step', 'project', 'best', 'restarts']
+
+class AttackProfiler:
+    """
+    Records per-iteration timings and peak memory of attack phases.
+
+    Every call to :meth:`phase` appends a record (a dictionary with keys
+    ``attack``, ``iteration``, ``phase``, ``time``, ``peak_mem`` and
+    ``rss_end``) to :samp:`self.records`. Times are in seconds (CUDA work is
+    synchronized before and after each phase). Memory is in bytes: on CUDA,
+    ``peak_mem`` is the peak allocated memory of the device during the phase
+    (``rss_end`` is -1); on CPU, where there is no per-phase peak,
+    ``rss_end`` is the resident set size of the process at the end of the
+    phase (``peak_mem`` is -1).
+
+    Args:
+        device (str|ch.device|None) : device the attack runs on (default:
+            CUDA if available)
+    """
+    def __init__(self, device=None):
+        if device is None:
+            device = 'cuda' if ch.cuda.is_available() else 'cpu'
+        self.device = ch.device(device)
+        self.records = []
+        self.num_attacks = 0
+        self.iteration = None
+
+    def start_attack(self):
+        """Marks the start of a new attack (call to the attacker)."""
+        self.num_attacks += 1
+        self.iteration = None
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager timing one phase of the current iteration."""
+        cuda = self.device.type == 'cuda'
+        if cuda:
+            ch.cuda.synchronize(self.device)
+            ch.cuda.reset_peak_memory_stats(self.device)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            peak_mem, rss_end = -1, -1
+            if cuda:
+                ch.cuda.synchronize(self.device)
+                peak_mem = ch.cuda.max_memory_allocated(self.device)
+            else:
+                rss_end = psutil.Process().memory_info().rss
+            self.records.append({
+                'attack': self.num_attacks,
+                'iteration': -1 if self.iteration is None else self.iteration,
+                'phase': name,
+                'time': time.perf_counter() - start,
+                'peak_mem': peak_mem,
+                'rss_end': rss_end
+            })
+
+    def summary(self):
+        """
+        Aggregate statistics per phase.
+
+        Returns:
+            An ordered dictionary mapping each phase to a dictionary with the
+            number of times it ran (``count``), its total and mean wall time
+            (``total_time``, ``mean_time``) and the largest ``peak_mem`` and
+            ``rss_end`` of its records (see :class:`AttackProfiler`).
+        """
+        summary = OrderedDict()
+        for phase in PHASES + sorted({r['phase'] for r in self.records} - set(PHASES)):
+            recs = [r for r in self.records if r['phase'] == phase]
+            if not recs: continue
+            total = sum(r['time'] for r in recs)
+            summary[phase] = {
+                'count': len(recs),
+                'total_time': total,
+                'mean_time': total / len(recs),
+                'peak_mem': max(r['peak_mem'] for r in recs),
+                'rss_end': max(r['rss_end'] for r in recs)
+            }
+        return summary
+
+    def write_to_store(self, store, table=constants.ATTACK_PROFILE_TABLE):
+        """
+        Writes the per-phase summary (one row per phase) to a table of a cox
+        store.
+        """
+        if table not in store.tables:
+            store.add_table(table, constants.ATTACK_PROFILE_SCHEMA)
+        for phase, stats in self.summary().items():
+            store[table].append_row(dict(phase=phase, **stats))
+
+    def write_to_writer(self, writer, global_step, prefix='attack_profile'):
+        """
+        Writes the total and mean time and the memory use (``peak_mem`` on
+        CUDA, ``rss_end`` on CPU) of each phase as tensorboard scalars.
+        """
+        mem = 'peak_mem' if self.device.type == 'cuda' else 'rss_end'
+        for phase, stats in self.summary().items():
+            for k in ['total_time', 'mean_time', mem]:
+                writer.add_scalar('_'.join([prefix, phase, k]), stats[k],
+                                  global_step)
+
+    def reset(self):
+        self.records = []
+        self.num_attacks = 0
+        self.iteration = None
@@ -35,3 +35,31 @@ LOGS_SCHEMA = {
 
 LOGS_TABLE = 'logs'
 
+ATTACK_PROFILE_SCHEMA = {
+    'phase':str,
+    'count':int,
+    'total_time':float,
+    'mean_time':float,
+    'peak_mem':int,
+    'rss_end':int
+}
+
+ATTACK_PROFILE_TABLE = 'attack_profile'
+
+ATTACK_TRACE_SCHEMA = {
+    'restart':int,
+    'iteration':int,
+    'num_first_success':int,
+    'adv_prec1':float,
+    'mean_loss':float
+}
+
+ATTACK_TRACE_TABLE = 'attack_trace'
+
+EPS_SWEEP_SCHEMA = {
+    'eps':float,
+    'adv_prec1':float,
+    'num_attacked':int
+}
+
+EPS_SWEEP_TABLE = 'eps_sweep'
@@ -0,0 +1,99 @@
+"""
+Helpers for multi-process (``torch.distributed``) evaluation, see
+:meth:`robustness.train.eval_model`. Each process (rank) evaluates a
+deterministic shard of the validation set, and the per-example results are
+gathered so that the metrics are exactly those of a single-process run.
+
+Launch one process per device (e.g. with ``torchrun``), and initialize the
+process group (e.g. with :meth:`init_distributed`) before calling
+:meth:`robustness.train.eval_model`.
+"""
+
+import torch as ch
+import torch.distributed as dist
+from torch.utils.data import DataLoader, Sampler
+
+def init_distributed(backend='gloo'):
+    """
+    Initializes the default process group from the environment variables
+    set by ``torchrun`` (``RANK``, ``WORLD_SIZE``, ``MASTER_ADDR``,
+    ``MASTER_PORT``), unless it is already initialized.
+
+    Returns:
+        A tuple :samp:`(rank, world_size)`.
+    """
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend, init_method='env://')
+    return dist.get_rank(), dist.get_world_size()
+
+def is_distributed():
+    """Whether the default process group is initialized (with >1 rank)."""
+    return dist.is_available() and dist.is_initialized() and \
+           dist.get_world_size() > 1
+
+class ShardSampler(Sampler):
+    """
+    Deterministic sampler for the shard ``rank`` of a dataset split between
+    ``num_replicas`` ranks: rank r gets indices r, r + num_replicas, ... in
+    order. Unlike ``DistributedSampler``, shards are not padded to equal
+    size, so every example is evaluated exactly once.
+    """
+    def __init__(self, num_examples, num_replicas, rank):
+        self.num_examples = num_examples
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __iter__(self):
+        return iter(range(self.rank, self.num_examples, self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank, self.num_examples, self.num_replicas))
+
+def shard_loader(loader, rank=None, num_replicas=None):
+    """
+    A copy of a (sequential) ``DataLoader`` serving only this rank's shard
+    of its dataset (see :class:`ShardSampler`).
+    """
+    rank = dist.get_rank() if rank is None else rank
+    num_replicas = dist.get_world_size() if num_replicas is None else num_replicas
+    sampler = ShardSampler(len(loader.dataset), num_replicas, rank)
+    return DataLoader(loader.dataset, batch_size=loader.batch_size,
+                      sampler=sampler, num_workers=loader.num_workers,
+                      collate_fn=loader.collate_fn,
+                      pin_memory=loader.pin_memory)
+
+def gather_shards(values):
+    """
+    All-gathers per-example values computed on the shards of
+    :class:`ShardSampler`, in dataset order.
+
+    Args:
+        values (ch.tensor) : the values for this rank's shard, in order
+
+    Returns:
+        A tensor with the values for the whole dataset (on every rank).
+    """
+    if values.dtype == ch.bool:
+        return gather_shards(values.to(ch.uint8)).bool()
+    world_size = dist.get_world_size()
+    size = ch.tensor([values.shape[0]], dtype=ch.long)
+    sizes = [ch.zeros_like(size) for _ in range(world_size)]
+    dist.all_gather(sizes, size)
+    sizes = [int(s) for s in sizes]
+
+    # all_gather needs equal sizes: pad every shard to the largest one
+    padded = ch.zeros(max(sizes), *values.shape[1:], dtype=values.dtype)
+    padded[:values.shape[0]] = values.cpu()
+    gathered = [ch.zeros_like(padded) for _ in range(world_size)]
+    dist.all_gather(gathered, padded)
+
+    full = ch.zeros(sum(sizes), *values.shape[1:], dtype=values.dtype)
+    for r, (shard, n) in enumerate(zip(gathered, sizes)):
+        full[r::world_size] = shard[:n]
+    return full
+
+def all_reduce_sum(*values):
+    """Sums floats across ranks (in float64)."""
+    t = ch.tensor(values, dtype=ch.float64)
+    dist.all_reduce(t, op=dist.ReduceOp.SUM)
+    return t.tolist()
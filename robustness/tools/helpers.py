@@ -2,7 +2,9 @@ import torch as ch
 
 import shutil
 import dill
+import math
 import os
+from contextlib import nullcontext
 from subprocess import Popen, PIPE
 import pandas as pd
 from PIL import Image
@@ -17,23 +19,165 @@ def has_attr(obj, k):
     except AttributeError as e:
         return False
 
-def calc_est_grad(func, x, y, rad, num_samples):
+def get_device(device=None):
+    """
+    Resolves a device specification into a ``ch.device``. If ``device`` is
+    ``None``, use CUDA if it is available and the CPU otherwise.
+    """
+    if device is None:
+        device = 'cuda' if ch.cuda.is_available() else 'cpu'
+    return ch.device(device)
+
+def autocast(device, enabled=True):
+    """
+    Mixed-precision context for running a model on ``device``: float16
+    autocast on CUDA and bfloat16 autocast on the CPU (a no-op if not
+    ``enabled``).
+    """
+    if not enabled:
+        return nullcontext()
+    device = ch.device(device)
+    dtype = ch.float16 if device.type == 'cuda' else ch.bfloat16
+    return ch.autocast(device.type, dtype=dtype)
+
+class ModuleWrapper(ch.nn.Module):
+    """
+    Stand-in for ``DataParallel`` for models on the CPU: runs
+    ``self.module`` directly, with the same state dict keys (so that
+    checkpoints are interchangeable).
+    """
+    def __init__(self, module):
+        super(ModuleWrapper, self).__init__()
+        self.module = module
+
+    def forward(self, *args, **kwargs):
+        return self.module(*args, **kwargs)
+
+def data_parallel(model, device, device_ids=None):
+    """
+    Wraps ``model`` in ``DataParallel`` (over ``device_ids``, default: all
+    GPUs) and moves it to ``device`` if it is a CUDA device; on the CPU
+    (where ``DataParallel`` would still try to use the GPUs of the host),
+    wraps it in a :class:`ModuleWrapper` instead.
+    """
+    device = ch.device(device)
+    if device.type == 'cuda':
+        return ch.nn.DataParallel(model, device_ids=device_ids).to(device)
+    return ModuleWrapper(model).to(device)
+
+def set_cpu_threads(num_threads=None):
+    """
+    Sets the number of intra-op threads PyTorch uses on CPU. If
+    ``num_threads`` is ``None``, respect ``OMP_NUM_THREADS`` if it is set and
+    otherwise use one thread per physical core available to this process
+    (hyperthreads mostly add contention for the dense conv/matmul kernels
+    that dominate attacks).
+
+    Returns:
+        The number of intra-op threads now in use.
+    """
+    if num_threads is None:
+        if 'OMP_NUM_THREADS' in os.environ:
+            return ch.get_num_threads()
+        num_threads = num_physical_cores()
+    ch.set_num_threads(num_threads)
+    return num_threads
+
+def num_physical_cores():
+    """
+    Number of physical cores available to this process (bounded by its CPU
+    affinity).
+    """
+    try:
+        available = len(os.sched_getaffinity(0))
+    except AttributeError:
+        available = os.cpu_count() or 1
+    try:
+        import psutil
+        physical = psutil.cpu_count(logical=False) or available
+    except ImportError:
+        physical = available
+    return max(1, min(available, physical))
+
+def calc_est_grad(func, x, y, rad, num_samples, chunk_size=None):
+    """
+    Estimates the gradient of :samp:`func(x, y)` (a vector of per-example
+    losses) with respect to :samp:`x` from :samp:`num_samples` antithetic
+    queries of radius :samp:`rad` (see
+    :meth:`robustness.attacker.Attacker.forward`).
+
+    If :samp:`chunk_size` is None, all queries are materialized at once
+    (:samp:`2 * (num_samples // 2)` copies of the batch). Otherwise, queries
+    are streamed :samp:`chunk_size` antithetic pairs at a time, so that peak
+    memory is set by :samp:`chunk_size` instead. The noise of each query is
+    a function of its index and of a seed drawn from the global RNG only
+    (see :meth:`_query_noise`), and the estimate is accumulated in float64,
+    so that for a fixed seed the estimate does not depend on
+    :samp:`chunk_size` (up to float64 rounding).
+    """
     B, *_ = x.shape
     Q = num_samples//2
-    N = len(x.shape) - 1
+    extender = [1] * (len(x.shape) - 1)
+    y_shape = [1] * (len(y.shape) - 1)
+    chunk_size = Q if chunk_size is None else chunk_size
+    seed = int(ch.randint(0, 2**62, (1,)).item())
     with ch.no_grad():
-        # Q * B * C * H * W
-        extender = [1]*N
-        queries = x.repeat(Q, *extender)
-        noise = ch.randn_like(queries)
-        norm = noise.view(B*Q, -1).norm(dim=-1).view(B*Q, *extender)
-        noise = noise / norm
-        noise = ch.cat([-noise, noise])
-        queries = ch.cat([queries, queries])
-        y_shape = [1] * (len(y.shape) - 1)
-        l = func(queries + rad * noise, y.repeat(2*Q, *y_shape)).view(-1, *extender) 
-        grad = (l.view(2*Q, B, *extender) * noise.view(2*Q, B, *noise.shape[1:])).mean(dim=0)
-    return grad
+        grad = ch.zeros(x.shape, dtype=ch.float64, device=x.device)
+        for start in range(0, Q, chunk_size):
+            C = min(chunk_size, Q - start)
+            # C x B x ... unit directions, one per (query, example)
+            noise = _query_noise(seed, start, C, x.shape, x.device, x.dtype)
+            norm = noise.view(C, B, -1).norm(dim=-1).view(C, B, *extender)
+            noise = (noise / norm).view(C * B, *x.shape[1:])
+            queries = x.repeat(C, *extender)
+            queries = ch.cat([queries - rad * noise, queries + rad * noise])
+            l = func(queries, y.repeat(2*C, *y_shape)).view(2, C, B, *extender)
+            # Antithetic pair q contributes (l_+ - l_-) * noise_q
+            contrib = (l[1] - l[0]) * noise.view(C, B, *x.shape[1:])
+            grad += contrib.to(ch.float64).sum(dim=0)
+        grad /= 2 * Q
+    return grad.to(x.dtype)
+
+def _splitmix64(z):
+    # SplitMix64 finalizer on int64 tensors (multiplications wrap around;
+    # right shifts are made logical by masking)
+    def lsr(v, k):
+        return (v >> k) & ((1 << (64 - k)) - 1)
+    z = (z ^ lsr(z, 30)) * -4658895280553007687  # 0xBF58476D1CE4E5B9
+    z = (z ^ lsr(z, 27)) * -7723592293110705685  # 0x94D049BB133111EB
+    return z ^ lsr(z, 31)
+
+# Number of noise elements hashed at a time by _query_noise (bounds the size
+# of its int64 temporaries)
+_NOISE_BLOCK = 2 ** 20
+
+def _query_noise(seed, start, num, shape, device, dtype):
+    """
+    Standard normal noise of shape :samp:`(num, *shape)` for the queries
+    :samp:`start, ..., start + num - 1` of :meth:`calc_est_grad`. The noise
+    of query q only depends on :samp:`seed` and q (a counter-based
+    generator: every element is a hash of its global index), so it is the
+    same however the queries are chunked. Elements are generated in blocks
+    of :samp:`_NOISE_BLOCK`, so that the integer temporaries stay small
+    whatever the number of queries.
+    """
+    size = 1
+    for d in shape: size *= d
+    total, base = num * size, start * size
+    key = _splitmix64(ch.tensor(seed, dtype=ch.int64)).item()
+    noise = ch.empty(total, device=device, dtype=dtype)
+    for off in range(0, total, _NOISE_BLOCK):
+        k = min(_NOISE_BLOCK, total - off)
+        idx = ch.arange(base + off, base + off + k, device=device,
+                        dtype=ch.int64)
+        # Two 24-bit uniforms in (0, 1) per element, for the Box-Muller
+        # transform
+        u1 = (((_splitmix64(2 * idx + key) >> 40) & 0xFFFFFF).to(ch.float32)
+              + 0.5) / 2**24
+        u2 = (((_splitmix64(2 * idx + 1 + key) >> 40) & 0xFFFFFF).to(ch.float32)
+              + 0.5) / 2**24
+        noise[off:off + k] = ch.sqrt(-2 * ch.log(u1)) * ch.cos(2 * math.pi * u2)
+    return noise.view(num, *shape)
 
 def ckpt_at_epoch(num):
     return '%s_%s' % (num, constants.CKPT_NAME)
@@ -137,6 +281,57 @@ class DataPrefetcher():
             if type(self.stop_after) is int and (count > self.stop_after):
                 break
 
+class EvalProgress:
+    """
+    Progress of an evaluation pass over a loader (see
+    :meth:`robustness.train.eval_model`), saved to disk after every batch so
+    that an interrupted evaluation can resume from the last completed batch.
+
+    Args:
+        path (str|None) : file to keep the progress in (re-opened if it
+            exists; if None, the progress is only kept in memory)
+        key (str) : identifies the evaluation (model, attack, ...); progress
+            saved under a different key is discarded
+    """
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.batches = 0
+        self.count = 0
+        self.loss_sum = 0.
+        self.top1_sum = 0.
+        self.top5_sum = 0.
+        self.correct = []
+        if path is not None and os.path.isfile(path):
+            state = ch.load(path)
+            if state['key'] == key:
+                self.__dict__.update(state)
+
+    def update(self, correct, loss_sum, top1_sum, top5_sum, n):
+        """
+        Records a completed batch of ``n`` examples (``correct`` is its
+        per-example top-1 correctness, or None) and saves the progress.
+        """
+        self.batches += 1
+        self.count += n
+        self.loss_sum += float(loss_sum)
+        self.top1_sum += float(top1_sum)
+        self.top5_sum += float(top5_sum)
+        if correct is not None:
+            self.correct.append(correct.detach().bool().cpu())
+        self.save()
+
+    def save(self):
+        if self.path is None: return
+        state = {k: getattr(self, k) for k in ['key', 'batches', 'count',
+                 'loss_sum', 'top1_sum', 'top5_sum', 'correct']}
+        ch.save(state, self.path + '.tmp')
+        os.replace(self.path + '.tmp', self.path)
+
+    def correct_vector(self):
+        """Per-example top-1 correctness of the completed batches."""
+        return ch.cat(self.correct) if self.correct else ch.zeros(0, dtype=ch.bool)
+
 class AverageMeter(object):
     """Computes and stores the average and current value"""
     def __init__(self):
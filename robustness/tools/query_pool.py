@@ -0,0 +1,101 @@
+"""
+A pool of worker processes for evaluating the queries of black-box
+(:samp:`est_grad`) attacks in parallel on many-core CPU machines. See
+:meth:`robustness.attacker.Attacker.forward` (argument :samp:`query_pool`).
+
+Each worker holds a handle to a single shared-memory copy of the model
+weights, and evaluates a contiguous shard of every query batch. Losses are
+returned in order, so the gradient estimate is reduced exactly as it would be
+in a single process. Example::
+
+    with QueryPool(model, num_workers=32) as pool:
+        _, adv = model(x, y, make_adv=True, est_grad=(0.5, 1000),
+                       query_pool=pool, **attack_kwargs)
+"""
+
+import torch as ch
+import torch.multiprocessing as mp
+
+from .helpers import set_cpu_threads, num_physical_cores
+
+# Set in each worker process by _init_worker
+_WORKER = {}
+
+def _init_worker(model, normalizer, custom_loss, num_threads):
+    set_cpu_threads(num_threads)
+    _WORKER.update(model=model.eval(), normalizer=normalizer,
+                   custom_loss=custom_loss)
+
+def _eval_shard(shard):
+    x, y, should_normalize = shard
+    model, normalizer = _WORKER['model'], _WORKER['normalizer']
+    custom_loss = _WORKER['custom_loss']
+    with ch.no_grad():
+        inp = normalizer(x) if should_normalize else x
+        if getattr(custom_loss, 'output_loss', False):
+            return custom_loss(*model(inp, with_latent=True), y)
+        if custom_loss:
+            return custom_loss(model, inp, y)[0]
+        return ch.nn.functional.cross_entropy(model(inp), y, reduction='none')
+
+class QueryPool:
+    """
+    Process pool evaluating per-example attack losses for batches of
+    queries.
+
+    Args:
+        attacker_model (AttackerModel) : the model to query (must be on CPU);
+            its weights are moved to shared memory
+        num_workers (int|None) : number of worker processes (default: the
+            number of physical cores divided by ``threads_per_worker``)
+        threads_per_worker (int) : intra-op threads in each worker
+        custom_loss (function|None) : custom attack loss, with the same
+            signature as in :meth:`robustness.attacker.Attacker.forward`. Must
+            be picklable (i.e. defined at the top level of a module), and
+            must be the same function passed to the attack.
+        start_method (str) : multiprocessing start method for the workers
+    """
+    def __init__(self, attacker_model, num_workers=None, threads_per_worker=1,
+                 custom_loss=None, start_method='spawn'):
+        if hasattr(attacker_model, 'module'):
+            attacker_model = attacker_model.module
+        model, normalizer = attacker_model.model, attacker_model.normalizer
+        if any(p.is_cuda for p in model.parameters()):
+            raise ValueError('QueryPool only supports models on the CPU')
+        model.share_memory()
+        normalizer.share_memory()
+
+        if num_workers is None:
+            num_workers = max(1, num_physical_cores() // threads_per_worker)
+        self.num_workers = num_workers
+        self.custom_loss = custom_loss
+        ctx = mp.get_context(start_method)
+        self.pool = ctx.Pool(num_workers, initializer=_init_worker,
+                             initargs=(model, normalizer, custom_loss,
+                                       threads_per_worker))
+
+    def __call__(self, x, y, should_normalize=True):
+        """
+        Evaluates the per-example loss of a batch of queries.
+
+        Args:
+            x (ch.tensor) : queries (images in :math:`[0, 1]`)
+            y (ch.tensor) : labels for the queries
+            should_normalize (bool) : whether to normalize the queries first
+
+        Returns:
+            A tensor of size N with the loss of each query, on the device of x.
+        """
+        xs, ys = x.detach().cpu().chunk(self.num_workers), y.cpu().chunk(self.num_workers)
+        shards = [(xi, yi, should_normalize) for xi, yi in zip(xs, ys)]
+        return ch.cat(self.pool.map(_eval_shard, shards)).to(x.device)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -6,9 +6,16 @@ from torchvision.utils import make_grid
 from cox.utils import Parameters
 
 from .tools import helpers
+from .attacker import STEPS
 from .tools.helpers import AverageMeter, ckpt_at_epoch, has_attr
 from .tools import constants as consts
+from .tools.adv_cache import AdvCache, model_fingerprint, attack_config
+from .tools.attack_profiler import AttackProfiler
+from .tools import distributed as dist_tools
+from torch.utils.data import DataLoader, SequentialSampler
 import dill 
+import copy
+import itertools
 import os
 import time
 import warnings
@@ -18,11 +25,6 @@ if int(os.environ.get("NOTEBOOK_MODE", 0)) == 1:
 else:
     from tqdm import tqdm as tqdm
 
-try:
-    from apex import amp
-except Exception as e:
-    warnings.warn('Could not import amp.')
-
 def check_required_args(args, eval_only=False):
     """
     Check that the required training arguments are present.
@@ -49,6 +51,9 @@ def check_required_args(args, eval_only=False):
     is_adv = bool(args.adv_train) or bool(args.adv_eval)
     if is_adv:
         check_args(adv_required_args)
+    # More required args for the alternative adversarial training modes
+    if has_attr(args, 'adv_train_mode') and args.adv_train_mode == 'free':
+        check_args(["free_replays"])
     # More required args if the user provides a custom training loss
     has_custom_train = has_attr(args, 'custom_train_loss')
     has_custom_adv = has_attr(args, 'custom_adv_loss')
@@ -74,17 +79,21 @@ def make_optimizer_and_schedule(args, model, checkpoint, params):
             other params will not update. If ``None``, update all params 
 
     Returns:
-        An optimizer (ch.nn.optim.Optimizer) and a scheduler
-            (ch.nn.optim.lr_schedulers module).
+        An optimizer (ch.nn.optim.Optimizer), a scheduler
+            (ch.nn.optim.lr_schedulers module) and a gradient scaler
+            (ch.cuda.amp.GradScaler, which is disabled unless training in
+            float16 mixed precision on CUDA).
     """
     # Make optimizer
     param_list = model.parameters() if params is None else params
     optimizer = SGD(param_list, args.lr, momentum=args.momentum,
                                 weight_decay=args.weight_decay)
 
-    if args.mixed_precision:
-        model.to('cuda')
-        model, optimizer = amp.initialize(model, optimizer, 'O1')
+    # Loss scaling for float16 mixed precision (CUDA only: on the CPU mixed
+    # precision uses bfloat16, which needs no scaling)
+    device = helpers.get_device(args.device if has_attr(args, 'device') else None)
+    scaler = ch.cuda.amp.GradScaler(enabled=bool(args.mixed_precision)
+                                    and device.type == 'cuda')
 
     # Make schedule
     schedule = None
@@ -117,16 +126,11 @@ def make_optimizer_and_schedule(args, model, checkpoint, params):
                   f' Stepping {steps_to_take} times instead...')
             for i in range(steps_to_take):
                 schedule.step()
-        
-        if 'amp' in checkpoint and checkpoint['amp'] not in [None, 'N/A']:
-            amp.load_state_dict(checkpoint['amp'])
 
-        # TODO: see if there's a smarter way to do this
-        # TODO: see what's up with loading fp32 weights and then MP training
-        if args.mixed_precision:
-            model.load_state_dict(checkpoint['model'])
+        if checkpoint.get('scaler') is not None:
+            scaler.load_state_dict(checkpoint['scaler'])
 
-    return optimizer, schedule
+    return optimizer, schedule, scaler
 
 def eval_model(args, model, loader, store):
     """
@@ -139,26 +143,127 @@ def eval_model(args, model, loader, store):
         loader (iterable) : a dataloader serving `(input, label)` batches from
             the validation set
         store (cox.Store) : store for saving results in (via tensorboardX)
+
+    If ``args.adv_cache_dir`` is set, adversarial examples are cached on disk
+    (keyed by the model weights, the attack arguments and the inputs, and
+    bounded by ``args.adv_cache_gb`` gigabytes), so that evaluating the same
+    model with the same attack again skips the attack. In distributed runs,
+    every rank uses its own subdirectory of ``args.adv_cache_dir``.
+
+    If ``args.profile_attack`` is set, the time and memory use of each
+    phase of the attack are logged to the ``attack_profile`` table of the
+    store (see :class:`~robustness.tools.attack_profiler.AttackProfiler`).
+
+    If ``args.attack_trace`` is set, the convergence of the attack is logged
+    to the ``attack_trace`` table of the store, with one row per (restart,
+    iteration): the number of examples first misclassified at that
+    iteration of that restart, and the adversarial accuracy and mean loss
+    had the attack been stopped there (see :meth:`_trace_rows`). Use it to
+    pick the smallest ``attack_steps`` and ``random_restarts`` that do not
+    change the adversarial accuracy. (This bypasses ``adv_cache_dir``.)
+
+    If ``args.eps_sweep`` is set (a comma-separated, increasing list of eps
+    values), adversarial accuracy is evaluated at every eps in a single pass
+    over the data instead (see :meth:`_eps_sweep`) and logged to the
+    ``eps_sweep`` table of the store; ``adv_prec1`` in the logs table is
+    then the accuracy at ``args.eps`` (NaN if it is not in the sweep).
+
+    If ``args.resume_eval`` is set (and there is a store), the results of
+    every batch (per-example correctness, loss and accuracy sums, and the
+    number of completed batches) are saved in the store directory as the
+    evaluation runs, and an interrupted evaluation of the same model with
+    the same attack resumes after its last completed batch. The loader must
+    serve the same batches in the same order on every run.
+
+    If called in every process of an initialized ``torch.distributed``
+    process group (see :mod:`robustness.tools.distributed`), each rank
+    evaluates a deterministic shard of ``loader`` (which must be a
+    sequential ``DataLoader``) on its own device (``args.device``), and the
+    per-example correctness is all-gathered, so that the accuracies are
+    exactly those of a single-process run. The returned dictionary then
+    also has the per-example correctness of the whole dataset
+    (``nat_correct`` and ``adv_correct``), and only rank 0 writes to the
+    store (resumable progress is kept per rank). Attack profiles and traces
+    only cover the shard of rank 0.
     """
     check_required_args(args, eval_only=True)
     start_time = time.time()
 
+    # Distributed evaluation: every rank evaluates its own shard
+    distributed = dist_tools.is_distributed()
+    rank = ch.distributed.get_rank() if distributed else 0
+    progress_dir = store.path if store is not None else None
+    if distributed:
+        loader = dist_tools.shard_loader(loader)
+        if rank != 0: store = None
+
     if store is not None: 
         store.add_table(consts.LOGS_TABLE, consts.LOGS_SCHEMA)
     writer = store.tensorboard if store else None
 
     assert not hasattr(model, "module"), "model is already in DataParallel."
-    model = ch.nn.DataParallel(model)
-
+    device = helpers.get_device(args.device if has_attr(args, 'device') else None)
+    device_ids = [device] if distributed and device.type == 'cuda' else None
+    model = helpers.data_parallel(model, device, device_ids)
+
+    # Progress of (resumable) evaluation passes, kept in the store directory
+    # (and in memory in distributed runs, to gather the results)
+    resume = progress_dir is not None and has_attr(args, 'resume_eval') \
+             and args.resume_eval
+    fingerprint = model_fingerprint(model) if resume else ''
+    def eval_progress(name, key):
+        if not resume:
+            return helpers.EvalProgress(None, key) if distributed else None
+        suffix = f'_rank{rank}' if distributed else ''
+        path = os.path.join(progress_dir, f'eval_progress_{name}{suffix}.pt')
+        return helpers.EvalProgress(path, key)
+
+    nat_progress = eval_progress('nat', fingerprint)
     prec1, nat_loss = _model_loop(args, 'val', loader, 
-                                        model, None, 0, False, writer)
+                                        model, None, 0, False, writer,
+                                        progress=nat_progress)
+    if distributed:
+        prec1, nat_loss, nat_correct = _gather_progress(nat_progress)
 
     adv_prec1, adv_loss = float('nan'), float('nan')
     if args.adv_eval: 
         args.eps = eval(str(args.eps)) if has_attr(args, 'eps') else None
         args.attack_lr = eval(str(args.attack_lr)) if has_attr(args, 'attack_lr') else None
-        adv_prec1, adv_loss = _model_loop(args, 'val', loader, 
-                                        model, None, 0, True, writer)
+        cache = None
+        if has_attr(args, 'adv_cache_dir'):
+            cache_gb = args.adv_cache_gb if has_attr(args, 'adv_cache_gb') else 10
+            # The cache is not safe for concurrent writers: in distributed
+            # runs, every rank keeps its own cache in a subdirectory
+            cache_dir = args.adv_cache_dir
+            if distributed:
+                cache_dir = os.path.join(cache_dir, f'rank{rank}')
+            cache = AdvCache(cache_dir, max_bytes=cache_gb * 2**30,
+                             namespace=model_fingerprint(model))
+        attack_stats = {}
+        if has_attr(args, 'eps_sweep'):
+            sweep = _eps_sweep(args, loader, model)
+            if store:
+                store.add_table(consts.EPS_SWEEP_TABLE, consts.EPS_SWEEP_SCHEMA)
+                for row in sweep:
+                    store[consts.EPS_SWEEP_TABLE].append_row(row)
+            adv_prec1 = next((r['adv_prec1'] for r in sweep
+                              if r['eps'] == args.eps), float('nan'))
+        else:
+            config = attack_config(_make_attack_kwargs(args, args.eps,
+                                   args.random_restarts, None, False))
+            adv_progress = eval_progress('adv', fingerprint + config)
+            adv_prec1, adv_loss = _model_loop(args, 'val', loader, 
+                                            model, None, 0, True, writer,
+                                            progress=adv_progress, cache=cache,
+                                            attack_stats=attack_stats)
+            if distributed:
+                adv_prec1, adv_loss, adv_correct = _gather_progress(adv_progress)
+        if store and 'profile' in attack_stats:
+            attack_stats['profile'].write_to_store(store)
+        if store and 'trace' in attack_stats:
+            store.add_table(consts.ATTACK_TRACE_TABLE, consts.ATTACK_TRACE_SCHEMA)
+            for row in _trace_rows(attack_stats['trace']):
+                store[consts.ATTACK_TRACE_TABLE].append_row(row)
     log_info = {
         'epoch':0,
         'nat_prec1':prec1,
@@ -172,8 +277,28 @@ def eval_model(args, model, loader, store):
 
     # Log info into the logs table
     if store: store[consts.LOGS_TABLE].append_row(log_info)
+    if distributed:
+        log_info['nat_correct'] = nat_correct
+        if args.adv_eval and not has_attr(args, 'eps_sweep'):
+            log_info['adv_correct'] = adv_correct
     return log_info
 
+def _gather_progress(progress):
+    """
+    *Internal function* (see :meth:`eval_model`). Accuracy, loss and
+    per-example correctness over the whole dataset, from the progress of
+    every rank of a distributed evaluation.
+    """
+    loss_sum, top1_sum, count = dist_tools.all_reduce_sum(
+            progress.loss_sum, progress.top1_sum, progress.count)
+    correct = dist_tools.gather_shards(progress.correct_vector())
+    if correct.shape[0] == count:
+        prec1 = 100. * correct.float().mean().item()
+    else:
+        # Correctness unavailable (e.g. multitask binary targets)
+        prec1, correct = top1_sum / count, None
+    return prec1, loss_sum / count, correct
+
 def train_model(args, model, loaders, *, checkpoint=None, dp_device_ids=None,
             store=None, update_params=None, disable_no_grad=False):
     """
@@ -191,6 +316,27 @@ def train_model(args, model, loaders, *, checkpoint=None, dp_device_ids=None,
             adv_train (int or bool, *required*)
                 if 1/True, adversarially train, otherwise if 0/False do 
                 standard training
+            adv_train_mode (str)
+                How to adversarially train (ignored unless ``adv_train``):
+                ``pgd`` (default) trains on PGD adversarial examples, ``free``
+                uses "free" adversarial training, which replays every batch
+                ``free_replays`` times and reuses each backward pass to update
+                both the weights and the perturbation (divide ``epochs`` by
+                ``free_replays`` to keep the same number of SGD steps), and
+                ``fgsm_rs`` does "fast" adversarial training with one FGSM
+                step from a random start in the eps ball (step size
+                ``fgsm_step_mult * eps``)
+            free_replays (int)
+                Number of replays per batch for ``adv_train_mode == 'free'``
+            fgsm_step_mult (float)
+                Step size (as a multiple of eps) for ``fgsm_rs`` training
+            co_check (int or bool)
+                If True/1 and ``adv_train_mode == 'fgsm_rs'``, check for
+                catastrophic overfitting every epoch by attacking a held-out
+                validation batch with ``co_check_steps`` steps of PGD. If the
+                robust accuracy drops by more than ``co_threshold`` (in
+                percentage points) below the best seen so far, restore the
+                best weights and stop training.
             epochs (int, *required*)
                 number of epochs to train for
             lr (float, *required*)
@@ -210,6 +356,9 @@ def train_model(args, model, loaders, *, checkpoint=None, dp_device_ids=None,
             adv_eval (int or bool)
                 If True/1, then also do adversarial evaluation, otherwise skip
                 (ignored if adv_train is True)
+            device (str, optional)
+                Device to train on (e.g. ``cuda`` or ``cpu``). If not given,
+                use CUDA if available and the CPU otherwise.
             log_iters (int, *required*)
                 How frequently (in epochs) to save training logs
             save_ckpt_iters (int, *required*)
@@ -234,6 +383,36 @@ def train_model(args, model, loaders, *, checkpoint=None, dp_device_ids=None,
                 attack, if False/0 use the last step
             random_restarts (int, *required if adv_train or adv_eval*)
                 Number of random restarts to use for adversarial evaluation
+            batched_restarts (int or bool, optional)
+                If True/1, run all random restarts as one large batch instead
+                of one after another (faster, but uses more memory)
+            early_stop (int or bool, optional)
+                If True/1, stop attacking each example as soon as it is
+                misclassified during adversarial evaluation (saves compute,
+                does not change adversarial accuracy)
+            compile_step (int or bool, optional)
+                If True/1, use compiled kernels fusing the attack step and
+                projection (for the ``inf`` and ``2`` constraints)
+            profile_attack (int or bool, optional)
+                If True/1, profile the phases of every attack iteration and
+                log per-phase times and memory use to tensorboard (see
+                :class:`~robustness.tools.attack_profiler.AttackProfiler`)
+            attack_trace (int or bool, optional)
+                If True/1, record the convergence of the attacks during
+                adversarial evaluation (see :meth:`eval_model`)
+            max_attack_batch (int, optional)
+                If given, run attacks on micro-batches of at most this many
+                examples (per device) to bound their memory use. Training
+                batches larger than this are also split into micro-batches
+                of this size, with gradient accumulation.
+            resume_eval (int or bool, optional)
+                If True/1, save evaluation progress to the store after every
+                batch and resume interrupted evaluations (see
+                :meth:`eval_model`; eval only)
+            eps_sweep (str, optional)
+                If given, a comma-separated increasing list of eps values to
+                evaluate adversarial accuracy at in one pass (see
+                :meth:`eval_model`; eval only)
             custom_train_loss (function, optional)
                 If given, a custom loss instead of the default CrossEntropyLoss.
                 Takes in `(logits, targets)` and returns a scalar.
@@ -241,7 +420,10 @@ def train_model(args, model, loaders, *, checkpoint=None, dp_device_ids=None,
                 If given, a custom loss function for the adversary. The custom
                 loss function takes in `model, input, target` and should return
                 a vector representing the loss for each element of the batch, as
-                well as the classifier output.
+                well as the classifier output. Losses decorated with
+                :meth:`robustness.attacker.output_loss` take in
+                `logits, latent, target` instead (see
+                :meth:`robustness.attacker.Attacker.forward`).
             custom_accuracy (function)
                 If given, should be a function that takes in model outputs
                 and model targets and outputs a top1 and top5 accuracy, will 
@@ -291,11 +473,13 @@ def train_model(args, model, loaders, *, checkpoint=None, dp_device_ids=None,
 
     # Initial setup
     train_loader, val_loader = loaders
-    opt, schedule = make_optimizer_and_schedule(args, model, checkpoint, update_params)
+    opt, schedule, scaler = make_optimizer_and_schedule(args, model, checkpoint,
+                                                        update_params)
 
     # Put the model into parallel mode
     assert not hasattr(model, "module"), "model is already in DataParallel."
-    model = ch.nn.DataParallel(model, device_ids=dp_device_ids).cuda()
+    device = helpers.get_device(args.device if has_attr(args, 'device') else None)
+    model = helpers.data_parallel(model, device, dp_device_ids)
 
     best_prec1, start_epoch = (0, 0)
     if checkpoint:
@@ -303,22 +487,45 @@ def train_model(args, model, loaders, *, checkpoint=None, dp_device_ids=None,
         best_prec1 = checkpoint[prec1_key] if prec1_key in checkpoint \
             else _model_loop(args, 'val', val_loader, model, None, start_epoch-1, args.adv_train, writer=None)[0]
 
+    # For fast (FGSM-RS) adversarial training, hold out a validation batch to
+    # detect catastrophic overfitting with a short PGD attack every epoch
+    co_batch, co_best = None, (-1.0, None)
+    if args.adv_train and has_attr(args, 'adv_train_mode') and \
+            args.adv_train_mode == 'fgsm_rs' and has_attr(args, 'co_check') \
+            and args.co_check:
+        co_batch = next(iter(val_loader))
+
     # Timestamp for training start time
     start_time = time.time()
 
     for epoch in range(start_epoch, args.epochs):
         # train for one epoch
         train_prec1, train_loss = _model_loop(args, 'train', train_loader, 
-                model, opt, epoch, args.adv_train, writer)
+                model, opt, epoch, args.adv_train, writer, scaler=scaler)
         last_epoch = (epoch == (args.epochs - 1))
 
+        stop_training = False
+        if co_batch is not None:
+            co_prec1 = _co_check(args, model, co_batch)
+            if writer: writer.add_scalar('co_check_pgd_prec1', co_prec1, epoch)
+            if co_prec1 >= co_best[0]:
+                co_best = (co_prec1, copy.deepcopy(model.state_dict()))
+            elif co_best[0] - co_prec1 > (args.co_threshold if
+                    has_attr(args, 'co_threshold') else 20.0):
+                warnings.warn(f'Catastrophic overfitting detected at epoch {epoch} '
+                              f'(held-out PGD accuracy {co_prec1:.2f} vs. '
+                              f'{co_best[0]:.2f}), restoring the best weights '
+                              'and stopping training.')
+                model.load_state_dict(co_best[1])
+                stop_training = True
+
         # evaluate on validation set
         sd_info = {
             'model':model.state_dict(),
             'optimizer':opt.state_dict(),
             'schedule':(schedule and schedule.state_dict()),
             'epoch': epoch+1,
-            'amp': amp.state_dict() if args.mixed_precision else None,
+            'scaler': scaler.state_dict(),
         }
 
 
@@ -331,7 +538,7 @@ def train_model(args, model, loaders, *, checkpoint=None, dp_device_ids=None,
         should_save_ckpt = (epoch % save_its == 0) and (save_its > 0)
         should_log = (epoch % args.log_iters == 0)
 
-        if should_log or last_epoch or should_save_ckpt:
+        if should_log or last_epoch or should_save_ckpt or stop_training:
             # log + get best
             ctx = ch.enable_grad() if disable_no_grad else ch.no_grad() 
             with ctx:
@@ -365,7 +572,8 @@ def train_model(args, model, loaders, *, checkpoint=None, dp_device_ids=None,
             # Log info into the logs table
             if store: store[consts.LOGS_TABLE].append_row(log_info)
             # If we are at a saving epoch (or the last epoch), save a checkpoint
-            if should_save_ckpt or last_epoch: save_checkpoint(ckpt_at_epoch(epoch))
+            if should_save_ckpt or last_epoch or stop_training:
+                save_checkpoint(ckpt_at_epoch(epoch))
 
             # Update the latest and best checkpoints (overrides old one)
             save_checkpoint(consts.CKPT_NAME_LATEST)
@@ -373,10 +581,265 @@ def train_model(args, model, loaders, *, checkpoint=None, dp_device_ids=None,
 
         if schedule: schedule.step()
         if has_attr(args, 'epoch_hook'): args.epoch_hook(model, log_info)
+        if stop_training: break
 
     return model
 
-def _model_loop(args, loop_type, loader, model, opt, epoch, adv, writer):
+def _co_check(args, model, batch):
+    """
+    *Internal function* (see :meth:`~robustness.train.train_model`).
+
+    Catastrophic overfitting check for fast adversarial training: returns the
+    top-1 accuracy on a held-out batch under a short PGD attack
+    (``co_check_steps`` steps with random start).
+    """
+    inp, target = batch
+    device = helpers.get_device(args.device if has_attr(args, 'device') else None)
+    inp, target = inp.to(device), target.to(device)
+    steps = args.co_check_steps if has_attr(args, 'co_check_steps') else 10
+    model.eval()
+    output = model(inp, target=target, make_adv=True, with_image=False,
+                   constraint=args.constraint, eps=args.eps,
+                   step_size=2.5 * args.eps / steps, iterations=steps,
+                   random_start=True)
+    with ch.no_grad():
+        prec1, = helpers.accuracy(output, target, topk=(1,))
+    return prec1.item()
+
+def _sgd_step(loss, opt, scaler):
+    """
+    *Internal function*: backpropagate a training loss and take an optimizer
+    step (with loss scaling if training in float16 mixed precision).
+    """
+    scaler.scale(loss).backward()
+    scaler.step(opt)
+    scaler.update()
+
+def _free_train_step(args, model, opt, scaler, inp, target, eps, criterion,
+                     delta):
+    """
+    *Internal function* (see :meth:`~robustness.train._model_loop`).
+
+    "Free" adversarial training step [SNG+19]_: replays the batch
+    ``args.free_replays`` times, and uses the single backward pass of each
+    replay both to update the weights and to take an ascent step on the
+    perturbation (with step size ``eps``). The perturbation ``delta`` is
+    carried over from the previous batch.
+
+    Returns:
+        The output, adversarial input, (unregularized) loss and regularization
+        term of the last replay, along with the perturbation to start the next
+        batch from.
+
+    .. [SNG+19] Shafahi et al., "Adversarial Training for Free!", 2019.
+    """
+    step = STEPS[args.constraint](orig_input=inp, eps=eps, step_size=eps)
+    if delta is None or delta.shape != inp.shape:
+        delta = ch.zeros_like(inp)
+
+    for _ in range(args.free_replays):
+        x = step.project(inp + delta).requires_grad_(True)
+        with helpers.autocast(inp.device, bool(args.mixed_precision)):
+            output = model(x, with_image=False)
+            loss = criterion(output, target)
+        if len(loss.shape) > 0: loss = loss.mean()
+
+        reg_term = 0.0
+        if has_attr(args, "regularizer"):
+            reg_term = args.regularizer(model, x, target)
+
+        opt.zero_grad()
+        scale = scaler.get_scale() if scaler.is_enabled() else 1.
+        _sgd_step(loss + reg_term, opt, scaler)
+
+        with ch.no_grad():
+            delta = step.project(step.step(x.detach(), x.grad / scale)) - inp
+
+    return output, x.detach(), loss, reg_term, delta
+
+def _skip_batches(loader, num_batches):
+    """
+    *Internal function*. The batches of ``loader`` after the first
+    ``num_batches`` (which must be the same on every pass, e.g. a
+    validation loader). For a sequential ``DataLoader`` the skipped batches
+    are not loaded at all.
+    """
+    if num_batches == 0:
+        return loader
+    if isinstance(loader, DataLoader) and isinstance(loader.sampler, SequentialSampler):
+        batches = list(loader.batch_sampler)[num_batches:]
+        return DataLoader(loader.dataset, batch_sampler=batches,
+                          num_workers=loader.num_workers,
+                          collate_fn=loader.collate_fn,
+                          pin_memory=loader.pin_memory)
+    return itertools.islice(loader, num_batches, None)
+
+def _accumulated_train_step(args, model, opt, scaler, inp, target, adv,
+                            attack_kwargs, criterion, max_batch, mixed_precision):
+    """
+    *Internal function* (see :meth:`~robustness.train._model_loop`).
+
+    Training step on a batch larger than ``args.max_attack_batch``: the batch
+    is attacked and backpropagated in micro-batches of at most ``max_batch``
+    examples, accumulating the gradients (weighted by micro-batch size, so
+    that they add up to the gradient of the mean loss over the batch), and
+    a single optimizer step is taken at the end. The attack loss is
+    normalized by the whole batch size, as in a full-batch attack. Batch
+    norm statistics are computed per micro-batch.
+
+    Returns:
+        The output, adversarial input, (unregularized) loss and
+        regularization term of the whole batch.
+    """
+    N = inp.shape[0]
+    outputs, final_inps = [], []
+    loss, reg_term = 0., 0.
+    opt.zero_grad()
+    for start in range(0, N, max_batch):
+        x, y = inp[start:start + max_batch], target[start:start + max_batch]
+        weight = x.shape[0] / N
+        with helpers.autocast(inp.device, mixed_precision):
+            output, final_inp = model(x, target=y, make_adv=adv,
+                                      loss_batch_size=N, **attack_kwargs)
+            mb_loss = criterion(output, y)
+        if len(mb_loss.shape) > 0: mb_loss = mb_loss.mean()
+
+        mb_reg = 0.0
+        if has_attr(args, "regularizer"):
+            mb_reg = args.regularizer(model, x, y)
+
+        scaler.scale((mb_loss + mb_reg) * weight).backward()
+        loss = loss + weight * mb_loss.detach()
+        if isinstance(mb_reg, ch.Tensor): mb_reg = mb_reg.detach()
+        reg_term = reg_term + weight * mb_reg
+        outputs.append(output.detach() if not isinstance(output, tuple)
+                       else tuple(o.detach() for o in output))
+        final_inps.append(final_inp.detach())
+
+    scaler.step(opt)
+    scaler.update()
+    if isinstance(outputs[0], tuple):
+        output = tuple(ch.cat(parts) for parts in zip(*outputs))
+    else:
+        output = ch.cat(outputs)
+    return output, ch.cat(final_inps), loss, reg_term
+
+def _eps_sweep(args, loader, model):
+    """
+    *Internal function* (see :meth:`eval_model`). Adversarial accuracy at
+    every eps in ``args.eps_sweep`` in one pass over the data.
+
+    Each batch is loaded once and attacked at each eps in increasing order:
+    an example misclassified at some eps is also misclassified at every
+    larger eps (the threat models are nested), so only the examples that
+    are still correctly classified are attacked again, starting from their
+    adversarial example at the previous eps (which lies in the larger ball
+    around the original input; with ``args.random_start``, the random start
+    around it is projected back onto that ball). The step size is
+    ``args.attack_lr`` at every eps.
+
+    Returns:
+        A list of rows ``{'eps', 'adv_prec1', 'num_attacked'}`` (the first one
+        at eps 0, i.e. natural accuracy).
+    """
+    eps_list = args.eps_sweep
+    if isinstance(eps_list, str):
+        eps_list = eps_list.split(',')
+    eps_list = [float(eval(str(e))) for e in eps_list]
+    if eps_list != sorted(eps_list):
+        raise ValueError(f'eps_sweep must be increasing, got {eps_list}')
+
+    has_custom_adv_loss = has_attr(args, 'custom_adv_loss')
+    adv_criterion = args.custom_adv_loss if has_custom_adv_loss else None
+    device = helpers.get_device(args.device if has_attr(args, 'device') else None)
+    model = model.eval()
+
+    num_correct = [0] * (len(eps_list) + 1)
+    num_attacked = [0] * (len(eps_list) + 1)
+    total = 0
+    iterator = tqdm(loader, total=len(loader))
+    for inp, target in iterator:
+        inp = inp.to(device, non_blocking=True)
+        target = target.to(device, non_blocking=True)
+        with ch.no_grad():
+            output = model(inp, with_image=False)
+        correct = output.argmax(dim=1) == target
+        num_correct[0] += int(correct.sum())
+        total += inp.shape[0]
+
+        adv = inp.clone()
+        for j, eps in enumerate(eps_list, 1):
+            idx = correct.nonzero().flatten()
+            num_attacked[j] += idx.shape[0]
+            if idx.shape[0] > 0:
+                attack_kwargs = _make_attack_kwargs(args, eps, args.random_restarts,
+                                                    adv_criterion, False)
+                output, adv_idx = model(adv[idx], target[idx], make_adv=True,
+                                        orig_input=inp[idx], **attack_kwargs)
+                adv[idx] = adv_idx.detach()
+                correct[idx] = output.argmax(dim=1) == target[idx]
+                _check_in_ball(args.constraint, adv[idx], inp[idx], eps)
+            num_correct[j] += int(correct.sum())
+
+        iterator.set_description('Eps sweep | ' + ' | '.join(
+            f'{e}: {100. * c / total:.2f}' for e, c in
+            zip([0.] + eps_list, num_correct)))
+
+    if dist_tools.is_distributed():
+        K = len(num_correct)
+        totals = dist_tools.all_reduce_sum(*num_correct, *num_attacked, total)
+        num_correct, num_attacked = totals[:K], [int(a) for a in totals[K:2*K]]
+        total = totals[-1]
+
+    return [{'eps': e, 'adv_prec1': 100. * c / total, 'num_attacked': a}
+            for e, c, a in zip([0.] + eps_list, num_correct, num_attacked)]
+
+def _check_in_ball(constraint, adv, inp, eps, tol=1e-4):
+    """
+    *Internal function*. Checks that the adversarial examples lie within
+    ``eps`` of the inputs (for the :math:`\ell_2` and :math:`\ell_\infty`
+    threat models, whatever the attack; other constraints are not checked).
+    """
+    if constraint in ['2', 'square_2', 'hsj_2']:
+        p = 2
+    elif constraint in ['inf', 'apgd', 'square_inf', 'hsj_inf']:
+        p = float('inf')
+    else:
+        return
+    dist = (adv - inp).view(adv.shape[0], -1).norm(p=p, dim=1)
+    if (dist > eps + tol).any():
+        raise RuntimeError(f'adversarial example at distance {dist.max():.6f} '
+                           f'outside of the eps={eps} ball')
+
+def _make_attack_kwargs(args, eps, random_restarts, adv_criterion, is_train):
+    """
+    *Internal function*. Arguments for the attack (see
+    :meth:`robustness.attacker.Attacker.forward`) from the training
+    arguments.
+    """
+    return {
+        'constraint': args.constraint,
+        'eps': eps,
+        'step_size': args.attack_lr,
+        'iterations': args.attack_steps,
+        'random_start': args.random_start,
+        'custom_loss': adv_criterion,
+        'random_restarts': random_restarts,
+        'use_best': bool(args.use_best),
+        'batched_restarts': bool(has_attr(args, 'batched_restarts')
+                                 and args.batched_restarts),
+        'early_stop': bool(not is_train and has_attr(args, 'early_stop')
+                           and args.early_stop),
+        'compile_step': bool(has_attr(args, 'compile_step')
+                             and args.compile_step),
+        'mixed_precision': bool(has_attr(args, 'mixed_precision')
+                                and args.mixed_precision),
+        'max_attack_batch': (args.max_attack_batch
+                             if has_attr(args, 'max_attack_batch') else None)
+    }
+
+def _model_loop(args, loop_type, loader, model, opt, epoch, adv, writer,
+                scaler=None, progress=None, cache=None, attack_stats=None):
     """
     *Internal function* (refer to the train_model and eval_model functions for
     how to train and evaluate models).
@@ -394,6 +857,19 @@ def _model_loop(args, loop_type, loader, model, opt, epoch, adv, writer):
         epoch (int) : which epoch we are currently on
         adv (bool) : whether to evaluate adversarially (otherwise standard)
         writer : tensorboardX writer (optional)
+        scaler (ch.cuda.amp.GradScaler) : gradient scaler for training (see
+            :meth:`make_optimizer_and_schedule`; ignored for evaluation)
+        progress (helpers.EvalProgress) : if given (evaluation only), record
+            the results of every batch in it, and skip the batches it
+            already has results for
+        cache (AdvCache) : if given (evaluation only), serve adversarial
+            examples from this cache (see
+            :class:`~robustness.tools.adv_cache.AdvCache`); it must be keyed
+            by the current weights of the model
+        attack_stats (dict) : if given, the attack profiler (under
+            ``'profile'``, with ``args.profile_attack``) and the convergence
+            statistics of the attack (under ``'trace'``, with
+            ``args.attack_trace``) of the loop are stored in it
 
     Returns:
         The average top1 accuracy and the average loss across the epoch.
@@ -429,26 +905,86 @@ def _model_loop(args, loop_type, loader, model, opt, epoch, adv, writer):
 
     attack_kwargs = {}
     if adv:
-        attack_kwargs = {
-            'constraint': args.constraint,
-            'eps': eps,
-            'step_size': args.attack_lr,
-            'iterations': args.attack_steps,
-            'random_start': args.random_start,
-            'custom_loss': adv_criterion,
-            'random_restarts': random_restarts,
-            'use_best': bool(args.use_best)
-        }
-
-    iterator = tqdm(enumerate(loader), total=len(loader))
+        attack_kwargs = _make_attack_kwargs(args, eps, random_restarts,
+                                            adv_criterion, is_train)
+        if not is_train and cache is not None:
+            attack_kwargs['cache'] = cache
+
+    # "Free" adversarial training replaces the attack with replays of each
+    # batch (see _free_train_step)
+    adv_train_mode = args.adv_train_mode if has_attr(args, 'adv_train_mode') else 'pgd'
+    free_train = is_train and adv and (adv_train_mode == 'free')
+    free_delta = None
+
+    # With max_attack_batch, training batches larger than it are processed in
+    # micro-batches with gradient accumulation (see _accumulated_train_step)
+    max_batch = args.max_attack_batch if has_attr(args, 'max_attack_batch') else None
+
+    # Fast adversarial training: a single FGSM step from a random start, with
+    # step size fgsm_step_mult * eps
+    if is_train and adv and (adv_train_mode == 'fgsm_rs'):
+        step_mult = args.fgsm_step_mult if has_attr(args, 'fgsm_step_mult') else 1.25
+        attack_kwargs.update({
+            'step_size': step_mult * eps,
+            'iterations': 1,
+            'random_start': True,
+            'use_best': False
+        })
+
+    device = helpers.get_device(args.device if has_attr(args, 'device') else None)
+
+    # Mixed precision: autocast the forward passes, and scale the loss if
+    # training in float16
+    mixed_precision = has_attr(args, 'mixed_precision') and bool(args.mixed_precision)
+    if scaler is None:
+        scaler = ch.cuda.amp.GradScaler(enabled=False)
+
+    # Attack profiling (returned in attack_stats)
+    profiler = None
+    if adv and has_attr(args, 'profile_attack') and args.profile_attack:
+        profiler = AttackProfiler(device=device)
+        attack_kwargs['profiler'] = profiler
+        if attack_stats is not None: attack_stats['profile'] = profiler
+
+    # Attack convergence traces (returned in attack_stats)
+    trace_stats = None
+    trace = adv and not is_train and has_attr(args, 'attack_trace') \
+            and args.attack_trace
+    if trace:
+        attack_kwargs.update({'return_info': True, 'trace': True})
+
+    # Resume an interrupted evaluation after its last completed batch
+    start = 0
+    if progress is not None and progress.batches > 0:
+        start = progress.batches
+        losses.update(progress.loss_sum / progress.count, progress.count)
+        top1.update(progress.top1_sum / progress.count, progress.count)
+        top5.update(progress.top5_sum / progress.count, progress.count)
+
+    iterator = tqdm(enumerate(_skip_batches(loader, start), start),
+                    total=len(loader), initial=start)
     for i, (inp, target) in iterator:
        # measure data loading time
-        target = target.cuda(non_blocking=True)
-        output, final_inp = model(inp, target=target, make_adv=adv,
-                                  **attack_kwargs)
-        loss = train_criterion(output, target)
+        inp = inp.to(device, non_blocking=True)
+        target = target.to(device, non_blocking=True)
+        accumulate = is_train and not free_train and (max_batch is not None) \
+                     and inp.shape[0] > max_batch
+        if free_train:
+            output, final_inp, loss, reg_term, free_delta = _free_train_step(
+                    args, model, opt, scaler, inp, target, eps, train_criterion,
+                    free_delta)
+        elif accumulate:
+            output, final_inp, loss, reg_term = _accumulated_train_step(
+                    args, model, opt, scaler, inp, target, adv, attack_kwargs,
+                    train_criterion, max_batch, mixed_precision)
+        else:
+            with helpers.autocast(device, mixed_precision):
+                ret = model(inp, target=target, make_adv=adv, **attack_kwargs)
+                output, final_inp = ret[:2]
+                loss = train_criterion(output, target)
+            if trace: trace_stats = _update_trace_stats(trace_stats, ret[2])
 
-        if len(loss.shape) > 0: loss = loss.mean()
+            if len(loss.shape) > 0: loss = loss.mean()
 
         model_logits = output[0] if (type(output) is tuple) else output
 
@@ -472,20 +1008,26 @@ def _model_loop(args, loop_type, loader, model, opt, epoch, adv, writer):
         except:
             warnings.warn('Failed to calculate the accuracy.')
 
-        reg_term = 0.0
-        if has_attr(args, "regularizer"):
-            reg_term =  args.regularizer(model, inp, target)
-        loss = loss + reg_term
+        if progress is not None:
+            correct = None
+            if len(target.shape) == 1:
+                correct, = helpers.accuracy(model_logits, target, exact=True)
+            n = inp.size(0)
+            progress.update(correct, losses.val * n, top1.val * n,
+                            top5.val * n, n)
+
+        # (free and accumulated training have already regularized and taken
+        # their SGD steps)
+        if not (free_train or accumulate):
+            reg_term = 0.0
+            if has_attr(args, "regularizer"):
+                reg_term =  args.regularizer(model, inp, target)
+            loss = loss + reg_term
 
         # compute gradient and do SGD step
-        if is_train:
+        if is_train and not (free_train or accumulate):
             opt.zero_grad()
-            if args.mixed_precision:
-                with amp.scale_loss(loss, opt) as sl:
-                    sl.backward()
-            else:
-                loss.backward()
-            opt.step()
+            _sgd_step(loss, opt, scaler)
         elif adv and i == 0 and writer:
             # add some examples to the tensorboard
             nat_grid = make_grid(inp[:15, ...])
@@ -513,6 +1055,66 @@ def _model_loop(args, loop_type, loader, model, opt, epoch, adv, writer):
         for d, v in zip(descs, vals):
             writer.add_scalar('_'.join([prec_type, loop_type, d]), v.avg,
                               epoch)
+        if profiler is not None:
+            profiler.write_to_writer(writer, epoch,
+                                     prefix='_'.join(['attack_profile', loop_type]))
+
+    if trace_stats is not None and attack_stats is not None:
+        attack_stats['trace'] = trace_stats
 
     return top1.avg, losses.avg
 
+def _update_trace_stats(stats, info):
+    """
+    *Internal function*. Adds the convergence statistics of a batch of
+    attacks (from the :samp:`loss_trace` and :samp:`first_success` of the
+    attack info, see :meth:`robustness.attacker.Attacker.forward`) to the
+    running totals ``stats`` (or starts them if ``stats`` is None). The
+    traces are moved to the CPU here (rather than in the attack, so that
+    ``DataParallel`` can gather them).
+    """
+    loss_trace = info['loss_trace'].float().cpu()
+    N, R, T = loss_trace.shape
+    # Examples that were never misclassified go in the last bin
+    first = info['first_success'].long().cpu()
+    first = ch.where(first < 0, ch.full_like(first, T), first)
+    # Earliest success over the first r+1 restarts
+    earliest = first.cummin(dim=1).values
+    hist = lambda v: ch.stack([ch.bincount(v[:, r], minlength=T+1)
+                               for r in range(R)])
+    batch_stats = {
+        'num_examples': N,
+        'first_success': hist(first),
+        'broken_by': hist(earliest),
+        'loss_sum': ch.nan_to_num(loss_trace).sum(dim=0),
+        'loss_count': (~ch.isnan(loss_trace)).sum(dim=0)
+    }
+    if stats is None:
+        return batch_stats
+    return {k: stats[k] + batch_stats[k] for k in stats}
+
+def _trace_rows(stats):
+    """
+    *Internal function*. Rows of the ``attack_trace`` table (see
+    :meth:`eval_model`) from the statistics of :meth:`_update_trace_stats`.
+    For restart r and iteration t, ``adv_prec1`` is the percentage of
+    examples that were not misclassified at any of the first t+1 iterations
+    of any of the first r+1 restarts. The last iteration of each restart
+    (``t = attack_steps``) is the final iterate, evaluated after the last
+    step.
+    """
+    N = stats['num_examples']
+    R, T = stats['loss_sum'].shape
+    broken = stats['broken_by'][:, :T].cumsum(dim=1)
+    mean_loss = stats['loss_sum'] / stats['loss_count'].clamp(min=1)
+    rows = []
+    for r in range(R):
+        for t in range(T):
+            rows.append({
+                'restart': r,
+                'iteration': t,
+                'num_first_success': int(stats['first_success'][r, t]),
+                'adv_prec1': 100. * (1 - float(broken[r, t]) / N),
+                'mean_loss': float(mean_loss[r, t])
+            })
+    return rows